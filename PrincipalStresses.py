@@ -1,102 +1,84 @@
 #################################################################################################################################
 # This Python snipped is meant to be included in a Paraview project. When used on the grid points of a mesh, it provides the more compressional, intermediate and less compressional principal stresses
-## Provided by Andres Felipe Rodriguez Corcho 
+# It works on the cell or point data (ATTRIBUTE) of single datasets and of every block of multi-block datasets
+## Provided by Andres Felipe Rodriguez Corcho
 ## University of Sydney
+##
+## The calculation itself lives in principal_stresses.py, set MODULE_DIR to the ABSOLUTE path of the folder of this repository
+## so Paraview can import it (Paraview does not run the filter from that folder, a relative path does not work).
 ##############################################################################################################################
 
-import numpy as np
-import scipy
-import builtins
-
-dev_stress = inputs[0].CellData["projStressTensor"]
-
-#########################################################
-####### Calculation for full stress tensor with arbitrary pressure
-P = np.full((len(dev_stress),),-5e8) #Arbitrary pressure to make all eigen values negative
-
-Pf= np.array([np.full((3,3),pressure)*np.eye(3) for pressure in P])
-
-#- Creating the full stress tensor
-data_stress_tensor_full = dev_stress.copy() + Pf
-
-#Eigen values and vectors of full tensor
-eigen_val_vec_full = [np.linalg.eigh(S) for S in data_stress_tensor_full]
-eigen_val_full = np.array([ev[0] for ev in eigen_val_vec_full])
-eigen_vec_full = np.array([evec[1] for evec in eigen_val_vec_full])
-
-#Eigen values and vectors of deviatoric tensor
-eigen_val_vec_dev = [np.linalg.eigh(S) for S in dev_stress]
-eigen_val_dev = np.array([ev[0] for ev in eigen_val_vec_dev])
-eigen_vec_dev = np.array([evec[1] for evec in eigen_val_vec_dev])
-
-#Getting sigmas for the deviatoric stress tensor -
-S_mc_dev=np.copy(eigen_val_dev[:,0]) #more compressional
-S_int_dev=np.copy(eigen_val_dev[:,1]) #intermediate
-S_lc_dev=np.copy(eigen_val_dev[:,2]) #less compressional
-
-#Getting sigmas for the full tensor
-S_mc_full=np.copy(eigen_val_full[:,0]) #more compressional
-S_int_full=np.copy(eigen_val_full[:,1]) #intermediate
-S_lc_full=np.copy(eigen_val_full[:,2]) #less compressional
-
-#Getting eigen vectors
-S_mc_v=eigen_vec_dev[:,:,0]
-S_int_v=eigen_vec_dev[:,:,1]
-S_lc_v=eigen_vec_dev[:,:,2]
-
-###Invariant stress in Megapascals
-second_invariant_stress = 1e-6*inputs[0].CellData["projStressField"]
-
-output.CellData.append(second_invariant_stress,"2nd Invariant stress tensor")
-
-# #Scale mc and mc sigmas
-# output.CellData.append(np.full((3,3),scale_fac), "scale mc-lc")
-# #Scale intermediate sigma
-
-S_mc,S_i,S_lc = (
-        (S_mc_dev.reshape(len(S_lc_full),1)*1e-6)/second_invariant_stress*S_mc_v , 
-        (S_int_dev.reshape(len(S_lc_full),1)*1e-6)/second_invariant_stress*S_int_v ,
-        (S_lc_dev.reshape(len(S_lc_full),1)*1e-6)/second_invariant_stress*S_lc_v)
-
-#Sigma saturated with the pressure
-output.CellData.append(1e-6*S_mc_dev.reshape(len(S_lc_dev),1), "Dev More compressional")
-output.CellData.append(1e-6*S_int_dev.reshape(len(S_lc_dev),1), "Dev Intermediate")
-output.CellData.append(1e-6*S_lc_dev.reshape(len(S_lc_dev),1), "Dev Less compressional")
-
-############################################################
-#### HERE THE CALCULATED FIELDS - Sigma is exported without the pressure
-#From smaller sigma to largest
-output.CellData.append(S_mc, "More compressional")
-output.CellData.append(S_i, "Intermediate")
-output.CellData.append(S_lc, "Less compressional")
-
-
-#Calculating the stress number
-R = [(ev_i - ev_lc)/(ev_mc - ev_lc) for ev_mc,ev_i,ev_lc in zip(1e-6*S_mc_dev.reshape(len(S_lc_dev),1),
-                                                               1e-6*S_int_dev.reshape(len(S_lc_dev),1),
-                                                               1e-6*S_lc_dev.reshape(len(S_lc_dev),1))]
-#print('stress_ratio is {}'.format(R))
-
-output.CellData.append(np.array(R), "Stress number")
-
-
-##Fault Regimes
-FaultRegimes = np.full(np.shape(np.array(R)),3)
-#Condition for Normal faulting 
-#More compressional in Y must be larger than intermediate and less compressional
-Nfault_ids = np.logical_and(np.abs(S_mc_v[:,1]) > np.abs(S_int_v[:,1]), 
-                np.abs(S_mc_v[:,1]) > np.abs(S_lc_v[:,1]))
-
-FaultRegimes[Nfault_ids] = 1
-
-#Condition for strike-slip
-StrikeFault_ids=np.logical_and(np.abs(S_int_v[:,1]) > np.abs(S_mc_v[:,1]), 
-                np.abs(S_int_v[:,1]) > np.abs(S_lc_v[:,1]))
-
-FaultRegimes[StrikeFault_ids] = 2
-
-#Condition for reverse faults - whatever is not 1 or 2 conditions
-
-output.CellData.append(FaultRegimes,"Fault regimes")
-
-
+import os
+import sys
+
+MODULE_DIR = ""  #Absolute path of the folder containing principal_stresses.py, e.g. "/home/user/RibbonCollision"
+if not os.path.isabs(MODULE_DIR) or not os.path.isfile(os.path.join(MODULE_DIR, "principal_stresses.py")):
+    raise ImportError("MODULE_DIR = {!r} is not the absolute path of the folder containing principal_stresses.py, "
+                      "set it at the top of the filter".format(MODULE_DIR))
+if MODULE_DIR not in sys.path:
+    sys.path.append(MODULE_DIR)
+
+import principal_stresses as ps
+import stress_cache
+import symmetric_eigen
+from vtkmodules.numpy_interface import dataset_adapter as dsa
+from vtkmodules.vtkCommonDataModel import vtkDataObject
+
+#Where the stress arrays are, "CellData" or "PointData"
+ATTRIBUTE = "CellData"
+TENSOR = "projStressTensor"
+INVARIANT = "projStressField"
+
+#Eigen solver, "analytic" (closed form with LAPACK fallback for degenerate cells) or "lapack"
+ENGINE = "analytic"
+#Bound of the working memory in bytes, cells are processed in chunks that fit in it
+MAX_MEMORY = ps.DEFAULT_MAX_MEMORY
+#Compute precision, None keeps the input precision, np.float32 halves the memory
+DTYPE = None
+#Axis parallel to gravity for the fault regimes (Y in the 2D and 3D models)
+VERTICAL_AXIS = 1
+#Number of threads, None uses every core
+WORKERS = None
+#Reuse the arrays computed earlier in the session for the same timestep and input
+USE_CACHE = True
+#Print the maximum deviation of the analytic solver from np.linalg.eigh on this dataset
+CHECK_ENGINE = False
+
+#Arbitrary pressure to make all eigen values of the full tensor negative
+P = ps.DEFAULT_PRESSURE
+
+options = dict(pressure=P, engine=ENGINE, max_memory=MAX_MEMORY, dtype=DTYPE, workers=WORKERS,
+               vertical_axis=VERTICAL_AXIS)
+
+info = inputs[0].GetInformation()
+timestep = info.Get(vtkDataObject.DATA_TIME_STEP()) if info.Has(vtkDataObject.DATA_TIME_STEP()) else None
+
+#Multi-block datasets are processed block by block, the output has the same block structure as the input
+if isinstance(inputs[0], dsa.CompositeDataSet):
+    blocks = zip(inputs[0], output)
+else:
+    blocks = [(inputs[0], output)]
+
+for block_in, block_out in blocks:
+    data_in = getattr(block_in, ATTRIBUTE)
+    if TENSOR not in data_in.keys():
+        continue
+
+    #NumPy views of the VTK buffers, nothing is copied
+    dev_stress = data_in[TENSOR]
+    second_invariant = data_in[INVARIANT]
+
+    if CHECK_ENGINE:
+        print("Deviation of the analytic solver from eigh: {}".format(symmetric_eigen.max_deviation(dev_stress)))
+
+    #Deviatoric and full sigmas (MPa), scaled eigen vectors, stress number, fault regimes and A phi, computed in place in
+    #preallocated arrays
+    if USE_CACHE:
+        outputs = stress_cache.default_cache.stress_outputs(timestep, dev_stress, second_invariant, **options)
+    else:
+        outputs = ps.stress_outputs(dev_stress, second_invariant, **options)
+
+    #The output arrays are contiguous, VTK wraps them without a copy
+    data_out = getattr(block_out, ATTRIBUTE)
+    for name, array in outputs.items():
+        data_out.append(array, name)
@@ -11,10 +11,19 @@ from UWGeodynamics import dimensionalise
 from UWGeodynamics import non_dimensionalise as nd
 from underworld import function as fn
 u = GEO.UnitRegistry
+import argparse
 import math
 import numpy as np
 import os
 import scipy
+import sys
+
+import spinup_store
+import material_events
+import ribbon_geometry
+from material_events import schedule_material_event
+from ribbon_geometry import RibbonGeometry
+import model_geometry as mgeo
 
 
 # In[2]:
@@ -75,12 +84,36 @@ rank    = GEO.rank
 
 # In[4]:
 
-#angle = 20
-shifted = 450 #distance of trench to ribbon
-nEls=(256,96,96)
+# Parameters of the run, they can be changed from the command line, e.g.
+# mpirun -np 48 python 3DRIbbonCollision.py --angle 20 --shifted 250 --outputPath collision_20
+parser = argparse.ArgumentParser(description="Collision of a buoyant ribbon with a continental margin.")
+parser.add_argument("--angle", type=float, default=0., help="angle of the ribbon, degrees (default: 0)")
+parser.add_argument("--shifted", type=float, default=250., help="distance of trench to ribbon, km (default: 250)")
+parser.add_argument("--nEls", type=int, nargs="+", default=[256, 96, 96], help="elements along x, y (and z)")
+parser.add_argument("--outputPath", default="collision_0", help="output directory (default: collision_0)")
+parser.add_argument("--restart-dir", default=None,
+                    help="spin-up to restart from and add the ribbon (default: run the spin-up)")
+parser.add_argument("--restart-step", type=int, default=220, help="checkpoint where the ribbon is added (default: 220)")
+parser.add_argument("--spinup-store", default=None,
+                    help="store of spin-ups, the run restarts from the spin-up of the same model (computed first "
+                         "when it is not in the store)")
+parser.add_argument("--spinup-only", action="store_true", help="stop after the spin-up, before the ribbon")
+parser.add_argument("--spinup-wait", type=float, default=0.,
+                    help="minutes to wait for a spin-up computed by another run (default: fail at once)")
+parser.add_argument("--ribbon-time", type=float, default=None,
+                    help="add the ribbon when the model reaches this time, Myr, spin-up and collision are then a "
+                         "single run without restart")
+# unknown arguments are left to PETSc
+args, petsc_args = parser.parse_known_args()
+if args.ribbon_time is not None and (args.restart_dir or args.spinup_store or args.spinup_only):
+    parser.error("--ribbon-time runs the spin-up and the collision at once, without restart or spin-up store")
+
+angle = args.angle
+shifted = args.shifted #distance of trench to ribbon
+nEls = tuple(args.nEls)
 dim = len(nEls)
 
-outputPath = "collision_0"
+outputPath = args.outputPath
 
 
 # In[5]:
@@ -255,26 +288,40 @@ fn_x = GEO.shapes.fn.input()[0]
 fn_y = GEO.shapes.fn.input()[1]
 fn_z = GEO.shapes.fn.input()[2]
 
+# the materials are added without filling the swarm, the same shapes are rebuilt in NumPy
+# (model_geometry.py) and the particles are all classified at once after the last material
+layout = mgeo.MaterialLayout()
+
+def add_material(name, shape, geometry):
+    return layout.add(Model.add_material(name=name, shape=shape, fill=False), geometry)
+
+def slab_layer(y):
+    return mgeo.slab_geo(nd(slab_xStart), nd(y), nd(slab_dx), nd(slab_dy/slab_layers), nd(BoxLength),
+                         orientation, nd(dpert))
+
+def backarc_layer(y, dx, dy):
+    return mgeo.backarc_geo(nd(backarc_xStart), nd(y), nd(dx), nd(dy), nd(BoxLength), orientation)
+
 #UMantle=Model.add_material(name="UpperMantle", shape=GEO.shapes.Layer(top=0.*u.kilometer, bottom=-660.*u.kilometer))
-UMantle = Model.add_material(name="upper mantle", shape= fn_y > nd(-660.0 * 10**3 * u.meter))
+UMantle = add_material("upper mantle", fn_y > nd(-660.0 * 10**3 * u.meter), mgeo.Above(nd(-660.0 * 10**3 * u.meter)))
 
 op1 = slabGeo(slab_xStart, s_y1, slab_dx, slab_dy/slab_layers,BoxLength, orientation)
-op1_fin = Model.add_material(name="oceanic plate 1", shape=op1)
+op1_fin = add_material("oceanic plate 1", op1, slab_layer(s_y1))
 
 op2 = slabGeo(slab_xStart, s_y2, slab_dx, slab_dy/slab_layers,BoxLength, orientation)
-op2_fin = Model.add_material(name = "oceanic plate 2", shape=op2)
+op2_fin = add_material("oceanic plate 2", op2, slab_layer(s_y2))
 
 op3 = slabGeo(slab_xStart, s_y3, slab_dx, slab_dy/slab_layers,BoxLength, orientation)
-op3_fin = Model.add_material(name = "oceanic plate 3", shape=op3)
+op3_fin = add_material("oceanic plate 3", op3, slab_layer(s_y3))
 
 op4 = slabGeo(slab_xStart, s_y4, slab_dx, slab_dy/slab_layers,BoxLength, orientation)
-op4_fin = Model.add_material(name = "oceanic plate 4", shape=op4)
+op4_fin = add_material("oceanic plate 4", op4, slab_layer(s_y4))
 
 ba1 = backarcGeo(backarc_xStart, 0.*u.km, backarc_dx, 50.*u.km,BoxLength, orientation)
-ba1_fin = Model.add_material(name="backArc1", shape=ba1)
+ba1_fin = add_material("backArc1", ba1, backarc_layer(0.*u.km, backarc_dx, 50.*u.km))
 
 ba2 = backarcGeo(backarc_xStart, -50.*u.km, backarc_dx-50*u.km, 50.*u.km,BoxLength, orientation)
-ba2_fin = Model.add_material(name="backArc2", shape=ba2)
+ba2_fin = add_material("backArc2", ba2, backarc_layer(-50.*u.km, backarc_dx-50*u.km, 50.*u.km))
 
 if orientation==-1:
     trans_xStart=BoxLength-trans_xStart
@@ -313,37 +360,39 @@ c2=GEO.shapes.Polygon(vertices=[(nd(craton_xStart), nd(-craton_dy/craton_layers)
     
 # t1 = GEO.shapes.Box(top=Model.top,      bottom=-trans_dy/trans_layers, 
 #                     minX=trans_xStart, maxX=trans_xStart+trans_dx)
-t1_fin = Model.add_material(name="trans1", shape=t1)
+t1_fin = add_material("trans1", t1, mgeo.rectangle(nd(trans_xStart), nd(trans_dx), 0., nd(-trans_dy/trans_layers)))
 
 
 # t2 = GEO.shapes.Box(top=-trans_dy/trans_layers, bottom=-trans_dy, 
 #                     minX=trans_xStart, maxX=trans_xStart+trans_dx)
-t2_fin = Model.add_material(name="trans2", shape=t2)
+t2_fin = add_material("trans2", t2, mgeo.rectangle(nd(trans_xStart), nd(trans_dx), nd(-trans_dy/trans_layers),
+                                                   nd(-trans_dy)))
 
 
 # c1 = GEO.shapes.Box(top=Model.top,      bottom=-craton_dy/craton_layers, 
 #                     minX=craton_xStart, maxX=craton_xStart+craton_dx)
-c1_fin = Model.add_material(name="craton1", shape=c1)
+c1_fin = add_material("craton1", c1, mgeo.rectangle(nd(craton_xStart), nd(craton_dx), 0., nd(-craton_dy/craton_layers)))
 
 
 # c2 = GEO.shapes.Box(top=-craton_dy/craton_layers, bottom=-craton_dy,
 #                     minX=craton_xStart, maxX=craton_xStart+craton_dx)
-c2_fin = Model.add_material(name="craton2", shape=c2)
+c2_fin = add_material("craton2", c2, mgeo.rectangle(nd(craton_xStart), nd(craton_dx), nd(-craton_dy/craton_layers),
+                                                    nd(-craton_dy)))
 
 
 bs = GEO.shapes.Polygon(vertices=[(nd(bouyStrip_xStart), 0.),
                              (nd(bouyStrip_xStart+bouyStrip_dx), 0.),
                              (nd(bouyStrip_xStart+bouyStrip_dx), 0.-nd(bouyStrip_dy)),
                              (nd(bouyStrip_xStart), 0.-nd(bouyStrip_dy))])
-bs_fin = Model.add_material(name="buoyStrip", shape=bs)
+bs_fin = add_material("buoyStrip", bs, mgeo.rectangle(nd(bouyStrip_xStart), nd(bouyStrip_dx), 0.,
+                                                     0.-nd(bouyStrip_dy)))
 
 
 # In[14]:
-shifted = 250 #distance of trench to ribbon
 ###########################################################################
 #angle we want the ribbon rotated, can be +ve or -ve
-## HERE YOU CHANGE THE ANGLE OF INITIAL COLLISION
-angle=0 #degres
+## THE ANGLE OF INITIAL COLLISION (--angle) AND THE DISTANCE OF TRENCH TO RIBBON (--shifted)
+## ARE SET WITH THE PARAMETERS OF THE RUN, AT THE TOP
 ###########################################################################
 rad = np.radians(angle)
 thetha=np.radians(90-angle)
@@ -376,43 +425,14 @@ if dim == 3:
     nx = -np.cos(rad)
     nz = np.sin(rad)
 
-    nx1=-np.cos(thetha)
-    nz1=-np.sin(thetha)
-    #Ribbon-Layer 1
-    #top
-    hsp5 = GEO.shapes.HalfSpace(normal=(0.,1.,0.), origin=(0, 0*u.km, 0.))
-    #floor
-    hsp1 = GEO.shapes.HalfSpace(normal=(0.,-1.,0.), origin=(0, -25*u.km, 0.))
-    #front cut
-    #hsp6 = GEO.shapes.HalfSpace(normal=(1.,0.,0.), origin=(ribbon_xStart, 0*u.km, (Model.maxCoord[2])))
-    hsp6 = GEO.shapes.HalfSpace(normal=(-nx1,0.,-nz1), origin=(ribbon_xStart+Wa, 0*u.km, (Model.maxCoord[2])))
-    #front
-    hsp2 = GEO.shapes.HalfSpace(normal=(nx, 0, nz), origin=(ribbon_xStart+Wa ,0.,(Model.maxCoord[2])))
-    #back
-    hsp3 = GEO.shapes.HalfSpace(normal=(-nx, 0, -nz), origin=(ribbon_xStart,0.,(Model.maxCoord[2])-H))
-    #width
-    hsp4 = GEO.shapes.HalfSpace(normal=(nx1, 0, nz1), origin=(ribbon_xStart+xAngle,0.,ribbon_dz))
-    
-
-    rib_shape1 = hsp1&hsp2&hsp3&hsp4&hsp5&hsp6
-    
-    #Ribbon-Layer 2
-    #top
-    hsp51 = GEO.shapes.HalfSpace(normal=(0.,1.,0.), origin=(0, -25*u.km, 0.))
-    #floor
-    hsp11 = GEO.shapes.HalfSpace(normal=(0.,-1.,0.), origin=(0, -50*u.km, 0.))
-    #front cut
-    #hsp61 = GEO.shapes.HalfSpace(normal=(1.,0.,0.), origin=(ribbon_xStart, -25*u.km, (Model.maxCoord[2])))
-    hsp61 = GEO.shapes.HalfSpace(normal=(-nx1,0.,-nz1), origin=(ribbon_xStart+Wa, -25*u.km, (Model.maxCoord[2])))
-    #front
-    hsp21 = GEO.shapes.HalfSpace(normal=(nx, 0, nz), origin=(ribbon_xStart+Wa ,0.,(Model.maxCoord[2])))
-    #back
-    hsp31 = GEO.shapes.HalfSpace(normal=(-nx, 0, -nz), origin=(ribbon_xStart,0.,(Model.maxCoord[2]-H)))
-    #width
-    hsp41 = GEO.shapes.HalfSpace(normal=(nx1, 0, nz1), origin=(ribbon_xStart+xAngle,0.,ribbon_dz))
-    
-    
-    rib_shape2 = hsp11&hsp21&hsp31&hsp41&hsp51&hsp61
+    # Ribbon-Layer 1 from the surface to -25 km, Ribbon-Layer 2 from -25 to -50 km, each between the
+    # top, floor, front cut, front, back and width half spaces (ribbon_geometry.py)
+    ribbon = RibbonGeometry(nx, nz, nd(Wa), nd(H), nd(xAngle), nd(ribbon_xStart), nd(ribbon_dz),
+                            nd(Model.maxCoord[2]),
+                            layers=[(0., nd(-25*u.km)), (nd(-25*u.km), nd(-50*u.km))])
+
+    rib_shape1 = ribbon.layer(1)
+    rib_shape2 = ribbon.layer(2)
     
     
 #rib1 = Model.add_material(name="ribbon_1", shape=rib_shape1)
@@ -428,9 +448,12 @@ rib4 = Model.add_material(name="ribbon_4")
 
 op_change = Model.add_material(name="oceanic plate 1 after phase change")
 
-lm = Model.add_material(name="lower mantle", shape= fn_y < nd(-660.0 * 10**3 * u.meter))
+lm = add_material("lower mantle", fn_y < nd(-660.0 * 10**3 * u.meter), mgeo.Below(nd(-660.0 * 10**3 * u.meter)))
 #lm=Model.add_material(name="lower mantle", shape=GEO.shapes.Layer(top=-660.*u.kilometer, bottom=Model.bottom))
 
+# single pass over the swarm, a material added later wins and the default is the 'Model' material
+Model.swarm_variables['materialField'].data[:] = layout.classify(Model.swarm.data, Model.index)[:, None]
+
 added_material_list = [lm, op1_fin, op2_fin, op3_fin, op4_fin, ba1_fin, ba2_fin, t1_fin, 
                        t2_fin, c1_fin, c2_fin, bs_fin, op_change, rib1, rib2]
 
@@ -495,7 +518,7 @@ op1_fin.phase_changes = GEO.PhaseChange((Model.y < nd(-150.*u.kilometers)),
 # op4_fin.phase_changes = GEO.PhaseChange((Model.y < nd(-150.*u.kilometers)),
 #                                           op_change.index)
 
-store = vis.Store("store" + str(shifted))
+store = vis.Store("store" + "{:g}".format(shifted))
 figure_one = vis.Figure(store, figsize=(1200,400))
 figure_one.append(Fig.Points(Model.swarm, fn_colour=Model.materialField, fn_mask=materialFilter, opacity=0.5, fn_size=2.0))
 store.step = 0
@@ -908,34 +931,85 @@ outputss=['pressureField',
 GEO.rcParams['default.outputs']=outputss
 
 
-# a single parameter to switch between restart workflow or not.
-RESTART = False #first run should be false, then true
 #GEO.rcParams["initial.nonlinear.tolerance"] = 4e-2
 GEO.rcParams["initial.nonlinear.tolerance"] = 1e-1
 GEO.rcParams["nonlinear.tolerance"] = 1e-2
+
+# Everything the spin-up depends on, the ribbon (angle, shifted) is only added at the restart.
+# Runs with the same parameters share their spin-up through the --spinup-store.
+spinup_duration = 30*u.megayear
+spinup_checkpoint_interval = 0.05*u.megayear
+collision_duration = 30*u.megayear
+spinup_parameters = {
+    "nEls": nEls,
+    "box": (boxLength, boxHeight, boxWidth, g_vec),
+    "scaling": (use_scaling, KL, KM, Kt),
+    "geometry": (slab_xStart, slab_dx, slab_dy, slab_dz, slab_layers, slab_crust,
+                 backarc_xStart, backarc_dx, backarc_dy, trans_xStart, trans_dx, trans_dy,
+                 craton_xStart, craton_dx, craton_dy, bouyStrip_xStart, bouyStrip_dx, bouyStrip_dy,
+                 dpert, orientation),
+    "materials": (spinup_store.file_digest(matprop.__file__), spinup_store.file_digest(matprop.modprop.__file__),
+                  [(material.name, material.minViscosity) for material in Model.materials],
+                  Model.minViscosity, Model.maxViscosity),
+    "solver": (scr_rtol, GEO.rcParams["initial.nonlinear.tolerance"], GEO.rcParams["nonlinear.tolerance"]),
+    "run": (spinup_duration, spinup_checkpoint_interval),
+    # the boundary conditions, phase changes, tracers and solver settings are set in the script
+    "code": [spinup_store.file_digest(path) for path in (__file__, mgeo.__file__, ribbon_geometry.__file__,
+                                                          material_events.__file__, spinup_store.__file__)],
+    "petsc": petsc_args,
+}
+
+restartDir = args.restart_dir
+if args.spinup_store is not None and restartDir is None:
+    spinups = spinup_store.SpinupStore(args.spinup_store)
+    spinupStep = None if args.spinup_only else args.restart_step
+    restartDir = spinups.lookup(spinup_parameters, spinupStep)
+    if restartDir is None:
+        # only one run can claim the spin-up, the others wait for it
+        claimed = GEO.uw.mpi.comm.bcast(spinups.begin(spinup_parameters) if rank == 0 else None, root=0)
+        if claimed:
+            # the spin-up checkpoints are written in the store
+            Model.outputDir = spinups.path(spinup_parameters)
+            Model.run_for(duration=spinup_duration, checkpoint_interval=spinup_checkpoint_interval)
+            barrier()
+            if rank == 0:
+                spinups.complete(spinup_parameters)
+            barrier()
+            Model.outputDir = outputPath
+            restartDir = spinups.path(spinup_parameters)
+        else:
+            restartDir = spinups.wait(spinup_parameters, spinupStep, timeout=args.spinup_wait*60)
+    if args.spinup_only:
+        sys.exit(0)
+
+# a single parameter to switch between restart workflow or not.
+RESTART = restartDir is not None #first run computes the spin-up, then restart from it with --restart-dir
 #print("check1")
-if RESTART == False: 
-    Model.run_for(duration=30*u.megayear,checkpoint_interval=0.05*u.megayear, restartStep=525) #here runs first time before onset of ribbon
+if args.ribbon_time is not None:
+    # the running model adds the ribbon when it reaches ribbonTime (material_events.py) and goes on with the
+    # collision, both layers in one pass
+    ribbonTime = args.ribbon_time*u.megayear
+    schedule_material_event(Model, "ribbon", ribbon, [rib1, rib2], time=ribbonTime)
+    Model.run_for(duration=ribbonTime+collision_duration, checkpoint_interval=spinup_checkpoint_interval)
+
+elif RESTART == False: 
+    Model.run_for(duration=spinup_duration,checkpoint_interval=spinup_checkpoint_interval, restartStep=525) #here runs first time before onset of ribbon
     #print("state")
     #Model.run_for(nstep=40, checkpoint_interval=1, restartStep=64)
+    if args.spinup_only:
+        sys.exit(0)
     
 else:
-    # if the restartDir is the same as the current Model.outputDir we don't
-    # require the `restartDir` argument. nstep MUST be 0 to allow the fancy
-    # ribbon addition below - Dont forget this does not calcualte anything, just for putting the ribbon and re-staring
-    Model.run_for(nstep=0, restartStep=220) #here i put where In time i want the ribbon, step is where the base model is
+    # nstep MUST be 0 to allow the fancy ribbon addition below - Dont forget this does not calcualte anything,
+    # just for putting the ribbon and re-staring. The restarted run writes its checkpoints in outputPath
+    Model.run_for(nstep=0, restartStep=args.restart_step, restartDir=restartDir) #here i put where In time i want the ribbon, step is where the base model is
     
     # do fancy ribbon addition via shape
     matField = Model.swarm_variables['materialField']
     
-    isInsideShape1 = rib_shape1.evaluate(Model.swarm.data)# where particle is inside the ribbon update it's materialField index
-    
-    Model.swarm_variables['materialField'].data[:] = np.where(isInsideShape1 == True, 
-                                                              rib1.index, matField.data )
-    isInsideShape2 = rib_shape2.evaluate(Model.swarm.data)# where particle is inside the ribbon update it's materialField index
-    
-    Model.swarm_variables['materialField'].data[:] = np.where(isInsideShape2 == True, 
-                                                              rib2.index, matField.data )
+    # only the particles in the bounding box of the ribbon are tested, both layers at once (layer 2 on the
+    # plane between them, as when it was written after layer 1)
+    ribbon.assign(Model.swarm.data, matField.data, [rib1.index, rib2.index])
     
 
 
@@ -957,8 +1031,9 @@ Fig.Points(Model.swarm, fn_colour=Model.materialField, colours='dem1', fn_size=1
 #GEO.rcParams["initial.nonlinear.tolerance"] = 1e-1
 
 #As the model was re-started before now it runs for the desired time!, no need to re-start again
-# now continue running model as usual.
-Model.run_for(duration=30*u.megayear,checkpoint_interval=0.05*u.megayear)
+# now continue running model as usual. With --ribbon-time the collision is already done
+if args.ribbon_time is None:
+    Model.run_for(duration=collision_duration,checkpoint_interval=0.05*u.megayear)
               #,restartStep=198)
 
 
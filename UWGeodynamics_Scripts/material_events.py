@@ -0,0 +1,71 @@
+############################################################################################
+## Material events scheduled inside a running UWGeodynamics model.
+## An event assigns a material to the particles inside a shape once the model reaches a time
+## or a step, e.g. to add the ribbon after the spin-up in the same job instead of stopping,
+## restarting with nstep=0 and rewriting the materialField.
+##
+## The event is a post solve function of the model, it is checked after every solve and fires
+## once: the materials it assigns are used from the next solve on.
+##
+## Usage:
+##   schedule_material_event(Model, "ribbon", rib_shape1, rib1, time=10.*u.megayear)
+############################################################################################
+
+import numpy as np
+
+
+def _index(material):
+    #Materials of the model or their indices
+    return getattr(material, "index", material)
+
+
+class MaterialEvent:
+    """Assign material (or materials) to the particles inside shape at time or at step, once.
+
+    shape is anything with an evaluate(coords) method, such as the GEO.shapes: it returns True for the
+    particles inside the shape, or, when a list of materials is given, the number (from 1) of the
+    material of each particle and 0 for the particles outside, so several materials are assigned in a
+    single evaluation.
+    """
+
+    def __init__(self, Model, shape, material, time=None, step=None):
+        if (time is None) == (step is None):
+            raise ValueError("A material event happens at a time or at a step")
+
+        self.Model = Model
+        self.shape = shape
+        materials = material if isinstance(material, (list, tuple)) else [material]
+        self.indices = np.array([_index(m) for m in materials])
+        self.time = time
+        self.step = step
+        self.fired = False
+
+    def due(self):
+        if self.step is not None:
+            return self.Model.step >= self.step
+        return self.Model.time >= self.time
+
+    def apply(self):
+        """Assign the materials on the particles of this process, returns how many changed."""
+        materialField = self.Model.swarm_variables["materialField"]
+        coords = self.Model.swarm.data
+        labels = np.asarray(self.shape.evaluate(coords)).reshape(len(coords)).astype(int)
+
+        inside = labels > 0
+        materialField.data[inside, 0] = self.indices[labels[inside] - 1]
+
+        return int(inside.sum())
+
+    def __call__(self):
+        if self.fired or not self.due():
+            return
+        self.apply()
+        self.fired = True
+
+
+def schedule_material_event(Model, name, shape, material, time=None, step=None):
+    """Register a MaterialEvent in Model.post_solve_functions under name and return it."""
+    event = MaterialEvent(Model, shape, material, time=time, step=step)
+    Model.post_solve_functions[name] = event
+
+    return event
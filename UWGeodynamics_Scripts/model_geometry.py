@@ -0,0 +1,138 @@
+############################################################################################
+## Initial material layout of the ribbon collision models, in NumPy.
+## The shapes of 3DRIbbonCollision.py (slabGeo, backarcGeo, the transitional crust, craton and
+## buoyant strip polygons, the upper and lower mantle layers and the ribbon half-spaces of
+## ribbon_geometry.RibbonGeometry.layer) are rebuilt from nondimensional values and the
+## particles are classified into material indices in a single pass, without Underworld. As
+## in the UWGeodynamics fill of the material field, a material added later wins over the
+## previous ones and the particles outside every shape take the default material.
+##
+## Polygons are tested with the even-odd rule in the (x, y) plane (extruded along z in 3D),
+## from an edge table built once per polygon; particles exactly on an edge may be classified
+## differently from Underworld.
+##
+## Usage:
+##   layout = MaterialLayout()
+##   layout.add(UMantle, Above(nd(-660.*u.km)))
+##   layout.add(op1_fin, slab_geo(...))
+##   Model.materialField.data[:, 0] = layout.classify(Model.swarm.data, Model.index)
+############################################################################################
+
+import numpy as np
+
+
+class Polygon:
+    """Polygon in the (x, y) plane, evaluate returns True for the points inside it."""
+
+    def __init__(self, vertices):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        start, end = self.vertices, np.roll(self.vertices, -1, axis=0)
+
+        #Edge table, horizontal edges never cross the horizontal ray of the test
+        edges = start[:, 1] != end[:, 1]
+        self.x0, self.y0 = start[edges, 0], start[edges, 1]
+        self.y1 = end[edges, 1]
+        self.dxdy = (end[edges, 0] - self.x0)/(self.y1 - self.y0)
+
+        self.lower = self.vertices.min(axis=0)
+        self.upper = self.vertices.max(axis=0)
+
+    def evaluate(self, coords):
+        x, y = coords[:, 0], coords[:, 1]
+        inside = np.zeros(len(coords), dtype=bool)
+        index = np.flatnonzero((x >= self.lower[0]) & (x <= self.upper[0]) &
+                               (y >= self.lower[1]) & (y <= self.upper[1]))
+        px, py = x[index], y[index]
+
+        #Crossings of the ray going from each point towards +x, one edge at a time
+        crossings = np.zeros(len(index), dtype=bool)
+        for x0, y0, y1, dxdy in zip(self.x0, self.y0, self.y1, self.dxdy):
+            crossings ^= ((y0 > py) != (y1 > py)) & (px < x0 + (py - y0)*dxdy)
+        inside[index] = crossings
+
+        return inside
+
+
+class Above:
+    """Points with a coordinate (y by default) strictly above value, as fn_y > value."""
+
+    def __init__(self, value, axis=1):
+        self.value, self.axis = float(value), axis
+
+    def evaluate(self, coords):
+        return coords[:, self.axis] > self.value
+
+
+class Below:
+    """Points with a coordinate (y by default) strictly below value, as fn_y < value."""
+
+    def __init__(self, value, axis=1):
+        self.value, self.axis = float(value), axis
+
+    def evaluate(self, coords):
+        return coords[:, self.axis] < self.value
+
+
+def mirror(xStart, dx, BoxLength, orientation):
+    """Start and extent along x of a shape, measured from the other side of the box when orientation is -1."""
+    if orientation == -1:
+        return BoxLength - xStart, dx*orientation
+    return xStart, dx
+
+
+def slab_geo(x, y, dx, dy, BoxLength, orientation, dpert):
+    """Layer of the subducting plate with its slab tip bent down by dpert (slabGeo)."""
+    if orientation == 1:
+        shape = [(x, y), (x+dx, y), (x+dx, y-dy), (x, y-dy), (x-dpert, y-dy-dpert), (x-dpert, y-dpert)]
+    else:
+        x, dx = mirror(x, dx, BoxLength, orientation)
+        shape = [(x, y), (x+dx, y), (x+dx, y-dy), (x, y-dy), (x+dpert, y-dy-dpert), (x+dpert, y-dpert)]
+
+    return Polygon(shape)
+
+
+def backarc_geo(x, y, dx, dy, BoxLength, orientation):
+    """Layer of the back-arc, with its end towards the trench dipping at 45 degrees (backarcGeo)."""
+    if orientation == 1:
+        shape = [(x, y), (x+dx, y), (x+dx-dy, y-dy), (x, y-dy)]
+    else:
+        x, dx = mirror(x, dx, BoxLength, orientation)
+        shape = [(x, y), (x+dx, y), (x+dx+dy, y-dy), (x, y-dy)]
+
+    return Polygon(shape)
+
+
+def rectangle(xStart, dx, top, bottom):
+    """Polygon of the transitional crust, craton and buoyant strip layers."""
+    return Polygon([(xStart, top), (xStart+dx, top), (xStart+dx, bottom), (xStart, bottom)])
+
+
+class MaterialLayout:
+    """Materials with their shapes, in the order they are added to the model."""
+
+    def __init__(self):
+        self.materials = []
+
+    def add(self, material, shape):
+        """Add a material (or its index) with a shape from this module, or anything with evaluate(coords)."""
+        self.materials.append((getattr(material, "index", material), shape))
+        return material
+
+    def classify(self, coords, default):
+        """Material index of every point, default outside all the shapes.
+
+        The shapes are tested from the last one added, each only on the points none of the later
+        ones holds.
+        """
+        coords = np.asarray(coords)
+        indices = np.full(len(coords), default, dtype=int)
+        pending = np.arange(len(coords))
+
+        for index, shape in reversed(self.materials):
+            if len(pending) == 0:
+                break
+            inside = np.asarray(shape.evaluate(coords[pending])).reshape(len(pending)).astype(bool)
+            indices[pending[inside]] = index
+            pending = pending[~inside]
+
+        return indices
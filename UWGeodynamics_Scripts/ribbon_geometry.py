@@ -0,0 +1,140 @@
+############################################################################################
+## Geometry of the ribbon of 3DRIbbonCollision.py, in NumPy.
+## The ribbon is a prism bounded by four vertical planes (front cut, front, back and width)
+## and split in layers by horizontal planes: layer 1 from the surface to -25 km, layer 2 from
+## -25 to -50 km. Each layer is the intersection of six half-spaces, inside where
+## dot(normal, x - origin) <= 0 as for GEO.shapes.HalfSpace.
+##
+## The ribbon fills a small part of the box, so only the particles inside its axis-aligned
+## bounding box are tested against the half-spaces, and all the layers are classified in the
+## same pass (a later layer wins on the plane shared with the previous one).
+##
+## All the values are nondimensional (GEO.nd).
+############################################################################################
+
+import numpy as np
+
+
+class HalfSpace:
+    """Points x with dot(normal, x - origin) <= 0."""
+
+    def __init__(self, normal, origin):
+        self.normal = np.asarray(normal, dtype=np.float64)
+        self.origin = np.asarray(origin, dtype=np.float64)
+
+    def evaluate(self, coords):
+        return (coords - self.origin) @ self.normal <= 0.
+
+
+class Intersection:
+    """Points inside all the half-spaces, evaluate returns (N,1) booleans like the GEO shapes."""
+
+    def __init__(self, half_spaces):
+        self.half_spaces = list(half_spaces)
+
+    def evaluate(self, coords):
+        inside = np.ones(len(coords), dtype=bool)
+        for half_space in self.half_spaces:
+            inside &= half_space.evaluate(coords)
+        return inside[:, None]
+
+
+class RibbonGeometry:
+    """Ribbon of 3DRIbbonCollision.py.
+
+    nx, nz        : normal of the front of the ribbon (-cos(angle), sin(angle))
+    Wa, H, xAngle : offsets of the front, back and width planes, with the orientation of the model
+    ribbon_xStart : x of the back of the ribbon at the far z side of the box
+    ribbon_dz     : z of the plane limiting the width of the ribbon
+    maxZ          : z of the far side of the box
+    layers        : (top, bottom) y of each layer
+    """
+
+    def __init__(self, nx, nz, Wa, H, xAngle, ribbon_xStart, ribbon_dz, maxZ, layers):
+        self.nx, self.nz = float(nx), float(nz)
+        self.Wa, self.H, self.xAngle = float(Wa), float(H), float(xAngle)
+        self.ribbon_xStart, self.ribbon_dz, self.maxZ = float(ribbon_xStart), float(ribbon_dz), float(maxZ)
+        self.layers = [(float(top), float(bottom)) for top, bottom in layers]
+
+    def _vertical_planes(self):
+        """(normal, origin) in the (x, z) plane of the front cut, front, back and width planes."""
+        nx, nz = self.nx, self.nz
+        #normal of the front cut and width planes, perpendicular to the front
+        nx1, nz1 = -nz, nx
+        front = (self.ribbon_xStart + self.Wa, self.maxZ)
+        return [((-nx1, -nz1), front),
+                ((nx, nz), front),
+                ((-nx, -nz), (self.ribbon_xStart, self.maxZ - self.H)),
+                ((nx1, nz1), (self.ribbon_xStart + self.xAngle, self.ribbon_dz))]
+
+    def half_spaces(self, layer):
+        """The six half-spaces of a layer (numbered from 1): top, floor and the vertical planes."""
+        top, bottom = self.layers[layer - 1]
+        half_spaces = [HalfSpace((0., 1., 0.), (0., top, 0.)),
+                       HalfSpace((0., -1., 0.), (0., bottom, 0.))]
+        for (nx, nz), (x, z) in self._vertical_planes():
+            half_spaces.append(HalfSpace((nx, 0., nz), (x, 0., z)))
+        return half_spaces
+
+    def layer(self, layer):
+        """Shape of a single layer (numbered from 1), e.g. for Model.add_material."""
+        return Intersection(self.half_spaces(layer))
+
+    @property
+    def bounding_box(self):
+        """(min, max) corners of the box holding all the layers.
+
+        The front and back planes are parallel, as the front cut and width planes, and the two pairs are
+        perpendicular, so the ribbon lies in the rectangle of their four intersections.
+        """
+        (m, o_cut), (n, o_front), (_, o_back), (_, o_width) = self._vertical_planes()
+        lhs = np.array([n, m])
+        corners = np.array([np.linalg.solve(lhs, [np.dot(n, origin_n), np.dot(m, origin_m)])
+                            for origin_n in (o_front, o_back) for origin_m in (o_cut, o_width)])
+
+        tops, bottoms = zip(*self.layers)
+        lower = np.array([corners[:, 0].min(), min(bottoms), corners[:, 1].min()])
+        upper = np.array([corners[:, 0].max(), max(tops), corners[:, 1].max()])
+        #Rounding of the corners must not drop particles on the planes
+        pad = 1e-9*np.max(np.abs(np.concatenate([lower, upper])))
+        return lower - pad, upper + pad
+
+    def candidates(self, coords):
+        """Indices of the particles inside the bounding box, one axis at a time."""
+        lower, upper = self.bounding_box
+        index = np.flatnonzero((coords[:, 0] >= lower[0]) & (coords[:, 0] <= upper[0]))
+        for axis in (1, 2):
+            values = coords[index, axis]
+            index = index[(values >= lower[axis]) & (values <= upper[axis])]
+        return index
+
+    def classify(self, coords):
+        """Indices of the candidate particles and their layer (0 outside the ribbon)."""
+        index = self.candidates(coords)
+        points = coords[index]
+
+        inside = np.ones(len(index), dtype=bool)
+        for (nx, nz), (x, z) in self._vertical_planes():
+            inside &= (points[:, 0] - x)*nx + (points[:, 2] - z)*nz <= 0.
+
+        labels = np.zeros(len(index), dtype=int)
+        y = points[:, 1]
+        for number, (top, bottom) in enumerate(self.layers, start=1):
+            labels[inside & (y <= top) & (y >= bottom)] = number
+
+        return index, labels
+
+    def evaluate(self, coords):
+        """Layer of every particle, 0 outside: a shape for material_events with one material per layer."""
+        labels = np.zeros(len(coords), dtype=int)
+        index, candidate_labels = self.classify(coords)
+        labels[index] = candidate_labels
+        return labels
+
+    def assign(self, coords, material_data, indices):
+        """Set material_data (N,1) of the particles of each layer to its material index, in a single pass."""
+        index, labels = self.classify(coords)
+        inside = labels > 0
+        material_data[index[inside], 0] = np.asarray(indices)[labels[inside] - 1]
+
+        return int(inside.sum())
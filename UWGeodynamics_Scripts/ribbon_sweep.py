@@ -0,0 +1,204 @@
+############################################################################################
+## Sweep of 3DRIbbonCollision.py over ribbon angles, trench to ribbon distances and resolutions.
+## Every variant runs as an MPI job in its own output directory
+## (<root>/collision_a<angle>_s<shifted>_r<nx>x<ny>x<nz>),
+## as many jobs as fit on the available cores run at the same time. The state of every variant
+## is kept in <root>/sweep_status.json, so running the sweep again only starts the variants that
+## are not done yet.
+##
+## With --spinup-store the spin-up shared by the variants (spinup_store.py) is computed first,
+## by a single job, and every variant restarts from it to add its ribbon.
+##
+## Usage:
+##   python ribbon_sweep.py --angles 0 20 45 85 --shifted 250 --np 48 --cores 192 --spinup-store spinups
+##   python ribbon_sweep.py --angles 0 45 --nEls 128x48x48 256x96x96 --np 48 --cores 192
+############################################################################################
+
+import argparse
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "3DRIbbonCollision.py")
+STATUS_FILE = "sweep_status.json"
+#Seconds between checks of the running jobs
+POLL_INTERVAL = 10.
+
+
+def resolution_name(nEls):
+    return "x".join(str(n) for n in nEls)
+
+
+def parse_resolutions(values):
+    """Resolutions of --nEls: one as separate numbers ("256 96 96") or several as "256x96x96 128x48x48"."""
+    if all("x" not in value for value in values):
+        return [tuple(int(value) for value in values)]
+    return [tuple(int(n) for n in value.split("x")) for value in values]
+
+
+def variant_name(angle, shifted, nEls):
+    return "collision_a{:g}_s{:g}_r{}".format(angle, shifted, resolution_name(nEls))
+
+
+def load_status(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_status(path, status):
+    """Write the status file through a temporary one, so it is never left half written."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def job_command(variant, ranks, mpirun="mpirun", python=sys.executable, script=SCRIPT, extra=()):
+    """mpirun command of a variant, the model writes its checkpoints in variant["outputPath"]."""
+    return (shlex.split(mpirun) + ["-np", str(ranks), python, script,
+                                   "--angle", "{:g}".format(variant["angle"]),
+                                   "--shifted", "{:g}".format(variant["shifted"]),
+                                   "--nEls"] + [str(n) for n in variant["nEls"]]
+            + ["--outputPath", variant["outputPath"]] + list(extra))
+
+
+def _launch(variant, ranks, mpirun, extra):
+    """Start the job of a variant in its directory, returns the process and its log file."""
+    os.makedirs(variant["outputPath"], exist_ok=True)
+    log = open(os.path.join(variant["outputPath"], "run.log"), "a")
+    #Relative outputs of the script (e.g. the visualisation store) stay in the variant directory
+    process = subprocess.Popen(job_command(variant, ranks, mpirun, extra=extra), cwd=variant["outputPath"],
+                               stdout=log, stderr=subprocess.STDOUT)
+    variant.update(status="running", started=time.strftime("%Y-%m-%dT%H:%M:%S"), ranks=ranks)
+    variant.pop("returncode", None)
+
+    return process, log
+
+
+def _finish(variant, process, log):
+    log.close()
+    variant.update(status="done" if process.returncode == 0 else "failed", returncode=process.returncode,
+                   finished=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def run_sweep(root, angles, shifted, resolutions=((256, 96, 96),), ranks=1, cores=None, mpirun="mpirun", extra=(),
+              dry_run=False, spinup_store=None):
+    """Run the variants of the sweep that are not done, ranks MPI processes each, on cores cores.
+
+    There is a variant for every angle, shifted distance and resolution (nEls) of resolutions.
+
+    With a spinup_store directory the shared spin-up is run first (a job that returns at once when
+    the store already holds it) and the variants restart from it.
+
+    Returns the status dictionary {name: {angle, shifted, nEls, outputPath, status, ...}}.
+    """
+    root = os.path.abspath(root)
+    os.makedirs(root, exist_ok=True)
+    status_path = os.path.join(root, STATUS_FILE)
+    status = load_status(status_path)
+
+    names = []
+    for angle, shift, nEls in itertools.product(angles, shifted, resolutions):
+        name = variant_name(angle, shift, nEls)
+        names.append(name)
+        variant = status.setdefault(name, {"angle": angle, "shifted": shift, "nEls": list(nEls), "status": "pending"})
+        #Jobs killed with the previous sweep start again
+        if variant["status"] != "done":
+            variant.update(status="pending", outputPath=os.path.join(root, name))
+    save_status(status_path, status)
+
+    queue = [name for name in names if status[name]["status"] == "pending"]
+    slots = max(1, (cores or os.cpu_count() or 1) // ranks)
+    print("{} variants to run, {} at a time".format(len(queue), slots))
+
+    spinups = []
+    if spinup_store is not None:
+        extra = list(extra) + ["--spinup-store", os.path.abspath(spinup_store)]
+        #The angle and the distance of the ribbon do not change the spin-up, one per resolution to run
+        for nEls in resolutions:
+            if any(status[name]["nEls"] == list(nEls) for name in queue):
+                spinups.append({"angle": angles[0], "shifted": shifted[0], "nEls": list(nEls),
+                                "outputPath": os.path.join(root, "spinup_r" + resolution_name(nEls))})
+
+    if dry_run:
+        for spinup in spinups:
+            print(" ".join(job_command(spinup, ranks, mpirun, extra=extra + ["--spinup-only"])))
+        for name in queue:
+            print(" ".join(job_command(status[name], ranks, mpirun, extra=extra)))
+        return status
+
+    running = {}
+    try:
+        for spinup in spinups:
+            key = os.path.basename(spinup["outputPath"])
+            status[key] = spinup
+            process, log = _launch(spinup, ranks, mpirun, extra + ["--spinup-only"])
+            running[key] = (process, log)
+            save_status(status_path, status)
+            print("{} started".format(key))
+            process.wait()
+            del running[key]
+            _finish(spinup, process, log)
+            save_status(status_path, status)
+            print("{} {}".format(key, spinup["status"]))
+            if spinup["status"] != "done":
+                return status
+
+        while queue or running:
+            while queue and len(running) < slots:
+                name = queue.pop(0)
+                running[name] = _launch(status[name], ranks, mpirun, extra)
+                save_status(status_path, status)
+                print("{} started".format(name))
+
+            time.sleep(POLL_INTERVAL if running else 0)
+            for name, (process, log) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[name]
+                _finish(status[name], process, log)
+                save_status(status_path, status)
+                print("{} {}".format(name, status[name]["status"]))
+    except KeyboardInterrupt:
+        for name, (process, log) in running.items():
+            process.terminate()
+            process.wait()
+            log.close()
+            status[name]["status"] = "interrupted"
+        save_status(status_path, status)
+        raise
+
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run 3DRIbbonCollision.py for several ribbon angles and distances.")
+    parser.add_argument("--angles", type=float, nargs="+", default=[0.], help="ribbon angles, degrees")
+    parser.add_argument("--shifted", type=float, nargs="+", default=[250.], help="trench to ribbon distances, km")
+    parser.add_argument("--nEls", nargs="+", default=["256x96x96"],
+                        help="resolutions, elements along x, y and z: \"256 96 96\" for one, "
+                             "\"256x96x96 128x48x48\" for several")
+    parser.add_argument("--root", default=".", help="directory of the variant directories and the status file")
+    parser.add_argument("--np", type=int, default=1, dest="ranks", help="MPI processes of each job")
+    parser.add_argument("--cores", type=int, default=None, help="cores available (default: all of this machine)")
+    parser.add_argument("--mpirun", default="mpirun", help="MPI launcher, e.g. \"mpiexec --bind-to core\"")
+    parser.add_argument("--spinup-store", default=None,
+                        help="store of spin-ups (spinup_store.py), the variants restart from the shared spin-up")
+    parser.add_argument("--dry-run", action="store_true", help="only print the commands")
+    args, extra = parser.parse_known_args(argv)
+
+    status = run_sweep(args.root, args.angles, args.shifted, parse_resolutions(args.nEls), args.ranks, args.cores,
+                       args.mpirun, extra, args.dry_run, args.spinup_store)
+    failed = [name for name, variant in status.items() if variant["status"] == "failed"]
+    if failed:
+        print("Failed: {}".format(", ".join(sorted(failed))))
+
+
+if __name__ == "__main__":
+    main()
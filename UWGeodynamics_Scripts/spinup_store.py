@@ -0,0 +1,121 @@
+############################################################################################
+## Store of spin-up runs shared by the ribbon variants.
+## The spin-up before the ribbon is added only depends on the geometry, the materials, the
+## resolution and the solver settings, not on the angle or the position of the ribbon. Each
+## spin-up is saved in <root>/<key>, where key is a hash of those parameters, and the
+## variants restart from its checkpoints instead of computing it again.
+##
+## <root>/<key>/spinup.json holds the parameters and the state of the spin-up ("running" while
+## it is computed, "complete" when the variants can restart from it). The run computing a spin-up
+## claims it first by creating <root>/<key>/spinup.lock, which only one run can do.
+############################################################################################
+
+import hashlib
+import json
+import os
+import time
+
+STATE_FILE = "spinup.json"
+LOCK_FILE = "spinup.lock"
+
+
+def file_digest(path):
+    """Hash of the content of a file (e.g. the material properties module)."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _canonical(parameters):
+    #Quantities with units and other objects are written as text, tuples as lists
+    return json.dumps(parameters, sort_keys=True, default=str)
+
+
+class SpinupStore:
+    """Directory of spin-up runs addressed by a hash of their parameters."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    @staticmethod
+    def key(parameters):
+        return hashlib.sha256(_canonical(parameters).encode()).hexdigest()[:16]
+
+    def path(self, parameters):
+        return os.path.join(self.root, self.key(parameters))
+
+    def _read_state(self, parameters):
+        try:
+            with open(os.path.join(self.path(parameters), STATE_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def state(self, parameters):
+        """None when the spin-up is not in the store, "running" or "complete" otherwise."""
+        state = self._read_state(parameters)
+        return None if state is None else state["state"]
+
+    def lookup(self, parameters, step=None):
+        """Directory of the complete spin-up of these parameters, None when it is not in the store.
+
+        With a step, the spin-up must also hold the checkpoint the variants restart from, a complete
+        spin-up without it is an error.
+        """
+        if self.state(parameters) != "complete":
+            return None
+
+        path = self.path(parameters)
+        if step is not None and not os.path.exists(os.path.join(path, "swarm-{}.h5".format(step))):
+            raise RuntimeError("The spin-up {} is complete but has no checkpoint {}, remove it to compute it again"
+                               .format(path, step))
+
+        return path
+
+    def begin(self, parameters):
+        """Claim a spin-up and mark it as running, False when another run already claimed it.
+
+        The claim is the exclusive creation of the lock file, so two runs cannot both compute the same
+        spin-up.
+        """
+        path = self.path(parameters)
+        os.makedirs(path, exist_ok=True)
+        try:
+            fd = os.open(os.path.join(path, LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write("{} {}\n".format(os.uname().nodename, os.getpid()))
+        self._write_state(parameters, "running")
+
+        return True
+
+    def wait(self, parameters, step=None, timeout=0., poll=60.):
+        """Directory of a spin-up claimed by another run, once it is complete (lookup).
+
+        Raises a TimeoutError when it is not complete after timeout seconds.
+        """
+        end = time.time() + timeout
+        while True:
+            path = self.lookup(parameters, step)
+            if path is not None:
+                return path
+            if time.time() >= end:
+                raise TimeoutError("The spin-up {} is computed by another run, or was interrupted (remove it to "
+                                   "start again)".format(self.path(parameters)))
+            time.sleep(min(poll, max(end - time.time(), 0.)))
+
+    def complete(self, parameters):
+        """Mark a spin-up as complete, the variants can restart from it."""
+        self._write_state(parameters, "complete")
+
+    def _write_state(self, parameters, state):
+        record = self._read_state(parameters) or {"parameters": json.loads(_canonical(parameters)),
+                                                  "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        record["state"] = state
+        if state == "complete":
+            record["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+        path = os.path.join(self.path(parameters), STATE_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,175 @@
+#################################################################################################################################
+# Benchmark of the principal-stress post-processing (principal_stresses.py) on synthetic stress tensors.
+# Every stage (eigen decomposition, stress number and fault regimes, scaled eigen vectors, and the whole stress_outputs
+# pipeline) is timed for each engine and mesh size, reporting cells per second and peak memory. Results are appended as
+# JSON lines, with the git revision, so runs of different versions can be compared.
+#
+# Usage:
+#   python benchmarks/bench_principal_stresses.py --sizes 1e4 1e5 1e6 1e7
+#   python benchmarks/bench_principal_stresses.py --compare benchmarks/principal_stresses.jsonl
+##############################################################################################################################
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import principal_stresses as ps  # noqa: E402
+
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, "benchmarks", "principal_stresses.jsonl")
+STAGES = ("decomposition", "regimes", "scaling", "pipeline")
+#Stages other than the pipeline are timed chunk by chunk so the largest sizes fit in memory
+STAGE_CHUNK = 10**6
+
+
+def synthetic_stress(n_cells, layout="packed", dtype=np.float64, seed=0):
+    """Random deviatoric stress tensors of magnitude ~10 MPa and their second invariant.
+
+    layout is "packed" (N,6), the Underworld order, or "dense" (N,3,3).
+    """
+    rng = np.random.default_rng(seed)
+    packed = np.empty((n_cells, 6), dtype=dtype)
+    second_invariant = np.empty(n_cells, dtype=dtype)
+    for start in range(0, n_cells, STAGE_CHUNK):
+        chunk = packed[start:start + STAGE_CHUNK]
+        chunk[:] = 1e7 * rng.standard_normal(chunk.shape)
+        #Remove the trace so the tensors are deviatoric
+        chunk[:, :3] -= chunk[:, :3].mean(axis=1, keepdims=True)
+        second_invariant[start:start + STAGE_CHUNK] = np.sqrt(0.5 * (chunk[:, :3]**2).sum(axis=1)
+                                                              + (chunk[:, 3:]**2).sum(axis=1))
+
+    if layout == "dense":
+        dense = np.empty((n_cells, 3, 3), dtype=dtype)
+        for (i, j), k in zip(((0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)), range(6)):
+            dense[:, i, j] = dense[:, j, i] = packed[:, k]
+        return dense, second_invariant
+
+    return packed, second_invariant
+
+
+def _timed(function, *args, **kwargs):
+    """Result, wall time and peak traced memory of a call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def measure_stage(stage, stress, second_invariant, engine, workers=1):
+    """Wall time and peak memory of a stage over all the cells.
+
+    The pipeline is a single stress_outputs call. The other stages are timed chunk by chunk, the inputs
+    they need (the eigen decomposition) are computed outside the timed calls.
+    """
+    if stage == "pipeline":
+        _, elapsed, peak = _timed(ps.stress_outputs, stress, second_invariant, engine=engine, workers=workers)
+        return elapsed, peak
+    if stage not in STAGES:
+        raise ValueError("Unknown stage {!r}".format(stage))
+
+    total, peak = 0., 0
+    for start in range(0, len(stress), STAGE_CHUNK):
+        index = slice(start, start + STAGE_CHUNK)
+        if stage == "decomposition":
+            _, elapsed, chunk_peak = _timed(ps.eigen_decomposition, stress[index], engine)
+        else:
+            values, vectors = ps.eigen_decomposition(stress[index], engine)
+            if stage == "regimes":
+                _, elapsed, chunk_peak = _timed(ps.stress_regime, values, vectors)
+            else:
+                _, elapsed, chunk_peak = _timed(ps.scaled_vectors, values, vectors, second_invariant[index])
+        total += elapsed
+        peak = max(peak, chunk_peak)
+
+    return total, peak
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, engines, stages, layout="packed", dtype=np.float64, repeat=3, workers=1):
+    """Benchmark records, one per (size, engine, stage), keeping the fastest of repeat runs."""
+    context = {"revision": _git_revision(), "numpy": np.__version__, "python": platform.python_version(),
+               "machine": platform.machine(), "cpus": os.cpu_count(), "layout": layout,
+               "dtype": np.dtype(dtype).name, "workers": workers,
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    records = []
+    for n_cells in sizes:
+        stress, second_invariant = synthetic_stress(n_cells, layout, dtype)
+        for engine in engines:
+            for stage in stages:
+                elapsed, peak = min(measure_stage(stage, stress, second_invariant, engine, workers)
+                                    for _ in range(repeat))
+                record = dict(context, cells=n_cells, engine=engine, stage=stage, seconds=elapsed,
+                              cells_per_second=n_cells / elapsed, peak_bytes=peak)
+                records.append(record)
+                print("{cells:>12d} {engine:>9s} {stage:>14s} {seconds:10.4f} s {cells_per_second:12.4g} cells/s "
+                      "{peak_mb:10.1f} MB".format(peak_mb=peak / 2**20, **record))
+        del stress, second_invariant
+
+    return records
+
+
+def compare(path, records):
+    """Print the speed of the new records relative to the latest matching ones stored in path."""
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            baseline[(record["cells"], record["engine"], record["stage"], record["layout"], record["dtype"])] = record
+
+    for record in records:
+        old = baseline.get((record["cells"], record["engine"], record["stage"], record["layout"], record["dtype"]))
+        if old is None:
+            continue
+        print("{:>12d} {:>9s} {:>14s} {:6.2f}x speed {:6.2f}x memory vs {}".format(
+            record["cells"], record["engine"], record["stage"], record["cells_per_second"] / old["cells_per_second"],
+            record["peak_bytes"] / max(old["peak_bytes"], 1), old["revision"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the principal-stress computation.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1e4, 1e5, 1e6],
+                        help="numbers of cells, up to 1e8 (default: 1e4 1e5 1e6)")
+    parser.add_argument("--engines", nargs="+", choices=ps.ENGINES, default=list(ps.ENGINES))
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--layout", choices=("packed", "dense"), default="packed")
+    parser.add_argument("--float32", action="store_true", help="single precision tensors")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="threads of the pipeline stage")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON lines file the records are appended to")
+    parser.add_argument("--compare", default=None, help="JSON lines file of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    records = run([int(n) for n in args.sizes], args.engines, args.stages, args.layout,
+                  np.float32 if args.float32 else np.float64, args.repeat, args.workers)
+
+    if args.compare:
+        compare(args.compare, records)
+
+    with open(args.output, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
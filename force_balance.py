@@ -0,0 +1,465 @@
+#################################################################################################################################
+# Force balance along the horizontal axis of a 2D section of the models (used by LithFoceBalance.ipynb).
+# The section is a Paraview CSV export (Points_0, Points_1, Txx-Tyy, pressureField, projStressTensor_*). The stresses
+# above the compensation depth are interpolated on a regular grid and integrated over depth to obtain the net stress,
+# the gravitational potential energy (GPE) and the shear force acting on the base of the lithosphere.
+#
+# The columns used from each CSV are converted once to .npy files in a .section_cache folder next to it and then
+# memory-mapped, the cache is rebuilt when the CSV changes (size or modification time). Without the cache the CSV is
+# streamed in chunks and only the rows above the compensation depth are kept. force_balance_models evaluates the
+# sections of several models in parallel, model_depth_sweep gives the profiles for a list of compensation depths.
+##############################################################################################################################
+
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import LinearNDInterpolator
+
+import uw_output
+
+#Models exported from the 2D simulations, their stress tensor has 3 components
+MODELS_2D = ("/2D_arc/", "/2D_arcN/")
+
+#Columns holding txx, tyy and txy in the CSV exports. Paraview writes the 3D tensor with 9 components
+#and the 2D tensor packed as xx, yy, xy
+STRESS_COLUMNS_3D = ("projStressTensor_0", "projStressTensor_4", "projStressTensor_1")
+STRESS_COLUMNS_2D = ("projStressTensor_0", "projStressTensor_1", "projStressTensor_2")
+
+#Components txx, tyy and txy of the projStressTensor saved in the UWGeodynamics checkpoints
+STRESS_COMPONENTS = ("xx", "yy", "xy")
+PRESSURE_FIELD = "pressureField"
+TENSOR_FIELD = "projStressTensor"
+
+#Pa*m to TN/m
+FORCE_SCALE = 1e-12
+
+CACHE_DIR_NAME = ".section_cache"
+#Rows parsed at a time when streaming a CSV
+CHUNK_ROWS = 2**18
+
+
+def section_columns(is_2d=False):
+    """Columns of a section CSV used by the force balance."""
+    return ("Points_0", "Points_1", "Txx-Tyy", "pressureField") + (STRESS_COLUMNS_2D if is_2d else STRESS_COLUMNS_3D)
+
+
+def read_section(path, columns, comp_depth=None, chunk_rows=CHUNK_ROWS):
+    """Stream columns of a section CSV, keeping only the rows with Points_1 >= comp_depth (all when None).
+
+    The CSV is parsed chunk_rows rows at a time with float64 columns, so the peak memory depends on the
+    retained rows rather than on the size of the file. Returns a dictionary of arrays in file order.
+    """
+    usecols = list(columns) if comp_depth is None or "Points_1" in columns else list(columns) + ["Points_1"]
+    parts = {column: [] for column in columns}
+    for chunk in pd.read_csv(path, usecols=usecols, dtype={column: np.float64 for column in usecols},
+                             chunksize=chunk_rows):
+        if comp_depth is not None:
+            chunk = chunk[chunk["Points_1"].to_numpy() >= comp_depth]
+        for column in columns:
+            parts[column].append(chunk[column].to_numpy())
+
+    return {column: np.concatenate(parts[column]) if parts[column] else np.empty(0)
+            for column in columns}
+
+
+def _cache_dir(path):
+    head, tail = os.path.split(os.path.abspath(path))
+    return os.path.join(head, CACHE_DIR_NAME, tail)
+
+
+def _save_atomic(path, save):
+    """Write a file through a temporary one, so an interrupted conversion never leaves a truncated file."""
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        save(f)
+    os.replace(tmp, path)
+
+
+def load_section(path, is_2d=False, cache=True, comp_depth=None):
+    """Columns of a section CSV needed by the force balance, as a dictionary of arrays.
+
+    With cache=True the columns are read from the CSV once, saved as .npy files in
+    .section_cache/<CSV name>/ and memory-mapped on the following loads. The cache is rebuilt when
+    the size or the modification time of the CSV changes. With cache=False the CSV is streamed
+    (read_section). In both cases only the rows with Points_1 >= comp_depth are returned when
+    comp_depth is given.
+    """
+    columns = section_columns(is_2d)
+    if not cache:
+        return read_section(path, columns, comp_depth)
+
+    cache_dir = _cache_dir(path)
+    meta_path = os.path.join(cache_dir, "source.json")
+    stat = os.stat(path)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+    cached = meta.get("columns", []) if meta.get("source") == source else []
+
+    missing = [column for column in columns if column not in cached]
+    if missing:
+        os.makedirs(cache_dir, exist_ok=True)
+        #The cache holds every row, so it serves any compensation depth
+        frame = read_section(path, missing)
+        for column in missing:
+            _save_atomic(os.path.join(cache_dir, column + ".npy"),
+                         lambda f, column=column: np.save(f, frame[column]))
+        #The metadata is written last, it validates the column files
+        meta = {"source": source, "columns": cached + missing}
+        _save_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+
+    section = {column: np.load(os.path.join(cache_dir, column + ".npy"), mmap_mode="r") for column in columns}
+    if comp_depth is None:
+        return section
+
+    above = np.flatnonzero(section["Points_1"] >= comp_depth)
+    return {column: section[column][above] for column in columns}
+
+
+def _structured_grid(x, y, values):
+    """Place the values on the grid of the unique coordinates when the points form a complete tensor-product grid.
+
+    Returns regX, regY and the (len(regY), len(regX), k) grid with depth decreasing along the rows, or None when
+    points are missing, repeated or off the grid (e.g. perturbed coordinates).
+    """
+    regX, ix = np.unique(x, return_inverse=True)
+    regY, iy = np.unique(y, return_inverse=True)
+    nx, ny = len(regX), len(regY)
+    if len(x) != nx*ny:
+        return None
+
+    #Each grid node must be hit exactly once
+    flat = (ny - 1 - iy.reshape(-1))*nx + ix.reshape(-1)
+    if np.bincount(flat, minlength=nx*ny).max() != 1:
+        return None
+
+    grid = np.empty((nx*ny, values.shape[1]), dtype=values.dtype)
+    grid[flat] = values
+
+    return regX, regY, grid.reshape(ny, nx, values.shape[1])
+
+
+def regrid_section(section, comp_depth, columns, structured=None):
+    """Interpolate columns of a section on the regular grid of its points above the compensation depth.
+
+    section is a DataFrame or a dictionary of arrays (load_section).
+
+    The CSV exports of the UW mesh usually lie on a regular grid already. When the points form a complete
+    tensor-product grid they are placed on it directly (structured=None detects it, False forces the
+    interpolation). Otherwise all the columns are interpolated with a single Delaunay triangulation of the
+    points, with the same result as scipy.interpolate.griddata(method='linear', fill_value=np.nan,
+    rescale=True) on each column.
+
+    Returns regX, regY (unique coordinates), the X, Y grids (depth decreasing along the rows) and a
+    dictionary with a (len(regY), len(regX)) array per column.
+    """
+    #Crop grid to compensation depth
+    above = np.where(np.asarray(section["Points_1"]) >= comp_depth)[0]
+    x = np.asarray(section["Points_0"])[above]
+    y = np.asarray(section["Points_1"])[above]
+    values = np.column_stack([np.asarray(section[column])[above] for column in columns])
+
+    fast = _structured_grid(x, y, values) if structured is not False else None
+    if fast is not None:
+        regX, regY, grids = fast
+        X, Y = np.meshgrid(regX, regY[::-1])
+    else:
+        regX, regY = np.unique(x), np.unique(y)
+        #Creating regular grid
+        X, Y = np.meshgrid(regX, regY[::-1])
+        interpolator = LinearNDInterpolator((x, y), values, fill_value=np.nan, rescale=True)
+        grids = interpolator(X, Y)
+
+    return regX, regY, X, Y, {column: grids[:, :, k] for k, column in enumerate(columns)}
+
+
+def _depth_segments(fields, Y, nan_policy):
+    """Trapezoids between consecutive rows of a stack of gridded fields, (n_fields, ny-1, nx)."""
+    fields = np.asarray(fields)
+    depth = -Y*1e3
+    dz = np.diff(depth, axis=0)
+    segments = dz*(fields[:, 1:, :] + fields[:, :-1, :])/2.0
+
+    if nan_policy == "omit":
+        segments = np.where(np.isnan(segments), 0., segments)
+    elif nan_policy != "propagate":
+        raise ValueError("nan_policy must be 'propagate' or 'omit', got {!r}".format(nan_policy))
+
+    return segments
+
+
+def depth_integrals(fields, Y, nan_policy="propagate"):
+    """Trapezoidal integral over depth of every column of a stack of gridded fields.
+
+    fields     : (n_fields, ny, nx) integrands on the grid of Y
+    Y          : (ny, nx) depth grid in km, as returned by regrid_section
+    nan_policy : "propagate" gives NaN for the columns with a missing value (as np.trapz),
+                 "omit" integrates only over the depth intervals where both ends are defined
+
+    Returns a (n_fields, nx) array in TN/m for stresses in Pa.
+    """
+    return FORCE_SCALE*_depth_segments(fields, Y, nan_policy).sum(axis=1)
+
+
+def cumulative_depth_integrals(fields, Y, nan_policy="propagate"):
+    """Depth integrals of depth_integrals accumulated from the surface, (n_fields, ny, nx).
+
+    Row k is the integral from the surface (row 0) down to row k, so row 0 is zero and the last row is
+    depth_integrals(fields, Y).
+    """
+    segments = _depth_segments(fields, Y, nan_policy)
+    cumulative = np.zeros((segments.shape[0], segments.shape[1] + 1, segments.shape[2]), dtype=segments.dtype)
+    np.cumsum(segments, axis=1, out=cumulative[:, 1:, :])
+
+    return FORCE_SCALE*cumulative
+
+
+def _cumulative_trapezoid(values, coords, axis=-1):
+    """Cumulative trapezoidal integral starting at 0, as scipy.integrate.cumtrapz(initial=0)."""
+    values = np.moveaxis(np.asarray(values), axis, -1)
+    coords = np.moveaxis(np.asarray(coords), axis, -1)
+    segments = np.diff(coords, axis=-1)*(values[..., 1:] + values[..., :-1])/2.0
+    cumulative = np.concatenate((np.zeros(segments.shape[:-1] + (1,)), np.cumsum(segments, axis=-1)), axis=-1)
+
+    return np.moveaxis(cumulative, -1, axis)
+
+
+def grid_force_balance(X, Y, pressure, txx, tyy, txy, ref_const=None, nan_policy="propagate"):
+    """Net stress, GPE and shear force of gridded fields, the core of section_force_balance.
+
+    The grids are (ny, nx) sections or (ny, nz, nx) volumes with the rows going down from the surface,
+    every other index is a profile integrated over depth. The shear force is integrated along x on the
+    deepest row.
+
+    Returns a dictionary with net_stress, GPE, shear_stress, (nx,) or (nz, nx), and ref_const.
+    """
+    #Computing full stress tensors
+    if ref_const is None:
+        ref_const = pressure.reshape(len(pressure), -1)[0][0]
+    SI = -1*pressure - ref_const
+
+    #Computing integrals, every profile of every integrand at once
+    ny = len(Y)
+    integrals = depth_integrals(np.stack((SI, txx, tyy)).reshape(3, ny, -1), Y.reshape(ny, -1), nan_policy)
+    integral_SI, integral_txx, integral_tyy = integrals.reshape((3,) + Y.shape[1:])
+    #Shear along the base of the section
+    integral_xy = FORCE_SCALE*_cumulative_trapezoid(txy[-1], X[-1]*1e3)
+
+    #Calculating final integrals
+    net_stress = integral_txx - integral_tyy
+    GPE = (integral_SI - integral_SI[..., 1:2]) + integral_tyy
+    shear_stress = -integral_xy
+
+    return {"net_stress": net_stress, "GPE": GPE, "shear_stress": shear_stress, "ref_const": ref_const}
+
+
+def section_force_balance(section, is_2d=False, comp_depth=-200.0, ref_const=None, nan_policy="propagate"):
+    """Net stress, GPE and shear force of one section.
+
+    ref_const is the pressure removed from the isotropic stress, by default the pressure at the top left
+    corner of this section. Post-collision sections use the reference of the pre-collision one.
+    nan_policy is passed to depth_integrals.
+
+    Returns a dictionary with regX, regY, X, Y, Txx_yy (grid), net_stress, GPE, shear_stress and ref_const.
+    """
+    txx_col, tyy_col, txy_col = STRESS_COLUMNS_2D if is_2d else STRESS_COLUMNS_3D
+    regX, regY, X, Y, grids = regrid_section(section, comp_depth,
+                                             ("Txx-Tyy", "pressureField", txx_col, tyy_col, txy_col))
+
+    result = grid_force_balance(X, Y, grids["pressureField"], grids[txx_col], grids[tyy_col], grids[txy_col],
+                                ref_const, nan_policy)
+    result.update({"regX": regX, "regY": regY, "X": X, "Y": Y, "Txx_yy": grids["Txx-Tyy"]})
+
+    return result
+
+
+def checkpoint_grids(output_dir, step, comp_depth=-200.0, z_index=None):
+    """Pressure and txx, tyy, txy of a UWGeodynamics checkpoint on the grid of the element centroids.
+
+    The fields are saved per element of the mesh, in the lexicographic order of the elements, so they are
+    reshaped to the element grid whatever the deformation of the mesh. A 2D checkpoint gives (ny, nx)
+    arrays and a 3D one (ny, nz, nx) arrays, or the (ny, nx) section of the element layer z_index. The rows
+    go down from the surface, as in regrid_section, and stop at the last row of centroids above comp_depth.
+
+    Returns X, Y, Z (km, Z is None for a section) and a dictionary with pressure, txx, tyy and txy in Pa.
+    """
+    with uw_output.Checkpoint(output_dir, step) as checkpoint:
+        resolution = checkpoint.resolution
+        nx, ny = resolution[:2]
+        rows = None
+        if len(resolution) == 3 and z_index is not None:
+            rows = slice(nx*ny*z_index, nx*ny*(z_index + 1))
+        #Element grid, then the rows from the surface down
+        shape = (-1, ny, nx) if len(resolution) == 3 and z_index is None else (ny, nx)
+
+        def grid(values):
+            values = values.reshape(shape)
+            return (values.transpose(1, 0, 2) if values.ndim == 3 else values)[::-1]
+
+        tensor = checkpoint.read(TENSOR_FIELD, STRESS_COMPONENTS, rows)*checkpoint.to_pascal(TENSOR_FIELD)
+        pressure = checkpoint.read(PRESSURE_FIELD, rows=rows)*checkpoint.to_pascal(PRESSURE_FIELD)
+        fields = {"pressure": grid(pressure)}
+        for name, k in zip(("txx", "tyy", "txy"), range(3)):
+            fields[name] = grid(tensor[:, k])
+
+        centroids = checkpoint.centroids(rows)*checkpoint.mesh_to_kilometer()
+        X, Y = grid(centroids[:, 0]), grid(centroids[:, 1])
+        Z = grid(centroids[:, 2]) if len(shape) == 3 else None
+
+    #Crop grid to compensation depth
+    above = np.all(Y.reshape(ny, -1) >= comp_depth, axis=1)
+    keep = slice(0, np.argmin(above) if not above.all() else ny)
+    crop = (lambda array: None if array is None else array[keep])
+
+    return crop(X), crop(Y), crop(Z), {name: crop(array) for name, array in fields.items()}
+
+
+def checkpoint_force_balance(output_dir, step, comp_depth=-200.0, z_index=None, ref_const=None,
+                             nan_policy="propagate"):
+    """grid_force_balance of a checkpoint (checkpoint_grids), with its X, Y and Z grids."""
+    X, Y, Z, fields = checkpoint_grids(output_dir, step, comp_depth, z_index)
+    result = grid_force_balance(X, Y, fields["pressure"], fields["txx"], fields["tyy"], fields["txy"], ref_const,
+                                nan_policy)
+    result.update({"X": X, "Y": Y, "Z": Z})
+
+    return result
+
+
+def compensation_depth_sweep(section, depths, is_2d=False, ref_const=None, nan_policy="propagate"):
+    """Net stress, GPE and shear force of one section for several compensation depths.
+
+    The section is regridded once down to the deepest compensation depth and the depth integrals are
+    accumulated from the surface (cumulative_depth_integrals). The profiles of a compensation depth are
+    read at the deepest grid row above it and the shear force along that row. A section on a regular
+    grid gives the results of section_force_balance at each depth. An interpolated section is
+    triangulated with the points down to the deepest depth, which can change the values next to the
+    shallower ones.
+
+    Returns a dictionary with depths, regX, regY, X, Y, ref_const and the (len(depths), len(regX)) arrays
+    net_stress, GPE and shear_stress.
+    """
+    depths = np.atleast_1d(np.asarray(depths, dtype=float))
+    txx_col, tyy_col, txy_col = STRESS_COLUMNS_2D if is_2d else STRESS_COLUMNS_3D
+    regX, regY, X, Y, grids = regrid_section(section, depths.min(), ("pressureField", txx_col, tyy_col, txy_col))
+    pressure, txx, tyy, txy = grids["pressureField"], grids[txx_col], grids[tyy_col], grids[txy_col]
+
+    #Deepest row above each compensation depth, the rows go down from the surface
+    rows = np.searchsorted(-Y[:, 0], -depths, side="right") - 1
+    if rows.min() < 0:
+        raise ValueError("Compensation depths above the top of the section: {}".format(depths[rows < 0]))
+
+    if ref_const is None:
+        ref_const = pressure[0][0]
+    SI = -1*pressure - ref_const
+
+    integral_SI, integral_txx, integral_tyy = cumulative_depth_integrals(np.stack((SI, txx, tyy)), Y,
+                                                                         nan_policy)[:, rows, :]
+    integral_xy = FORCE_SCALE*_cumulative_trapezoid(txy[rows, :], X[rows, :]*1e3, axis=1)
+
+    net_stress = integral_txx - integral_tyy
+    GPE = (integral_SI - integral_SI[:, 1:2]) + integral_tyy
+    shear_stress = -integral_xy
+
+    return {"depths": depths, "regX": regX, "regY": regY, "X": X, "Y": Y, "net_stress": net_stress, "GPE": GPE,
+            "shear_stress": shear_stress, "ref_const": ref_const}
+
+
+def _crop(result, x1, x2):
+    """Restrict the profiles of a section to x1 <= x <= x2."""
+    if x1 is None or x2 is None:
+        return result["regX"], result["net_stress"], result["GPE"], result["shear_stress"]
+
+    indxs = np.where(np.logical_and(result["regX"] >= x1, result["regX"] <= x2))[0]
+    return (result["regX"][indxs], result["net_stress"][indxs], result["GPE"][indxs],
+            result["shear_stress"][indxs])
+
+
+def model_tuple(result, x1=None, x2=None, x1P=None, x2P=None):
+    """Outputs of get_stress_GPE_shearV2 from the {"pre": ..., "post": ...} sections of a model."""
+    pre, post = result["pre"], result["post"]
+    ### Filtering X distance
+    regX, net_stress, GPE, shear_stress = _crop(pre, x1, x2)
+    regXp, net_stressp, GPEp, shear_stressP = _crop(post, x1P, x2P)
+
+    return (regX, pre["regY"], net_stress, GPE, shear_stress,
+            regXp, post["regY"], net_stressp, GPEp, shear_stressP,
+            pre["Txx_yy"], post["Txx_yy"], pre["X"], post["X"], pre["Y"], post["Y"])
+
+
+def _section_task(path, is_2d, comp_depth, ref_const, cache):
+    return section_force_balance(load_section(path, is_2d, cache, comp_depth), is_2d, comp_depth, ref_const)
+
+
+def force_balance_models(ddr, models, file_seeds, comp_depth=-200.0, jobs=None, cache=True):
+    """Force balance of the pre- and post-collision sections of several models, computed in parallel.
+
+    Every section is a task of a pool of jobs processes (the number of cores by default, jobs=1 runs
+    them in this process). A post-collision section is submitted as soon as the pre-collision one of
+    the same model is done, as it uses its pressure reference.
+
+    Returns a dictionary {model: {"pre": section, "post": section}} with the section_force_balance
+    dictionaries, model_tuple gives the outputs of get_stress_GPE_shearV2 for one model.
+    """
+    paths = {model: [ddr+'/'+model+'/'+seed for seed in file_seeds] for model in models}
+    results = {model: {} for model in models}
+
+    if jobs == 1:
+        for model in models:
+            is_2d = model in MODELS_2D
+            results[model]["pre"] = _section_task(paths[model][0], is_2d, comp_depth, None, cache)
+            results[model]["post"] = _section_task(paths[model][1], is_2d, comp_depth,
+                                                   results[model]["pre"]["ref_const"], cache)
+        return results
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(_section_task, paths[model][0], model in MODELS_2D, comp_depth, None, cache):
+                   (model, "pre") for model in models}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                model, snapshot = pending.pop(future)
+                results[model][snapshot] = future.result()
+                if snapshot == "pre":
+                    #The post-collision pressure is referred to the pre-collision one
+                    post = executor.submit(_section_task, paths[model][1], model in MODELS_2D, comp_depth,
+                                           results[model]["pre"]["ref_const"], cache)
+                    pending[post] = (model, "post")
+
+    return results
+
+
+def model_depth_sweep(ddr, model, file_seeds, depths, cache=True):
+    """compensation_depth_sweep of the pre- and post-collision sections of a model, {"pre": ..., "post": ...}."""
+    is_2d = model in MODELS_2D
+    deepest = np.min(depths)
+
+    pre = compensation_depth_sweep(load_section(ddr+'/'+model+'/'+file_seeds[0], is_2d, cache, deepest),
+                                   depths, is_2d)
+    post = compensation_depth_sweep(load_section(ddr+'/'+model+'/'+file_seeds[1], is_2d, cache, deepest),
+                                    depths, is_2d, ref_const=pre["ref_const"])
+
+    return {"pre": pre, "post": post}
+
+
+def get_stress_GPE_shearV2(ddr, model, file_seeds, comp_depth=-200.0, OP=False, SP=False, OP_SP=False,
+                           x1=None, x2=None, x1P=None, x2P=None, cache=True):
+    """Force balance of the pre- and post-collision sections of a model.
+
+    ddr        : directory with the model folders (data_forceBalance)
+    model      : model folder, e.g. "/0_deg/"
+    file_seeds : pre- and post-collision CSV file names
+    x1, x2     : optional horizontal range kept for the pre-collision profiles (x1P, x2P post-collision)
+    cache      : load the CSVs through the binary column cache (load_section)
+
+    Returns regX, regY, net_stress, GPE, shear_stress, regXp, regYp, net_stressp, GPEp, shear_stressP,
+    Txx_yy, Txx_yyP, X, Xp, Y, Yp.
+    """
+    result = force_balance_models(ddr, [model], file_seeds, comp_depth, jobs=1, cache=cache)[model]
+
+    return model_tuple(result, x1, x2, x1P, x2P)
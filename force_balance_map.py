@@ -0,0 +1,90 @@
+#################################################################################################################################
+# Map view of the force balance of a 3D UWGeodynamics run.
+# Every (x, z) column of elements of a checkpoint is integrated over depth down to the compensation depth at once
+# (force_balance.checkpoint_force_balance on the whole volume), which gives (z, x) maps of the net stress, the GPE, the
+# basal shear force and their sum, without exporting any section from Paraview. The maps of each checkpoint are saved
+# to <results_dir>/forceBalanceMap-<step>.h5.
+#
+# Usage:
+#   python force_balance_map.py collision_0 --steps 220 400 --comp-depth -200
+##############################################################################################################################
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+
+import force_balance as fb
+import uw_output
+
+PREFIX = "forceBalanceMap"
+COMPONENTS = ("net_stress", "GPE", "shear_stress", "total")
+
+
+def map_force_balance(output_dir, step, comp_depth=-200.0, ref_const=None):
+    """(nz, nx) maps of net_stress, GPE, shear_stress and total (their sum) of a 3D checkpoint.
+
+    The GPE of each z row is referred to its second column and the shear force is integrated along x on
+    the deepest row of elements, as along a section. X and Z are the element centroids of the surface row.
+    """
+    result = fb.checkpoint_force_balance(output_dir, step, comp_depth, ref_const=ref_const)
+    if result["Z"] is None:
+        raise ValueError("{} is a 2D run, use force_balance_timeseries.py for its profiles".format(output_dir))
+
+    maps = {name: result[name] for name in ("net_stress", "GPE", "shear_stress")}
+    maps["total"] = maps["net_stress"] + maps["GPE"] + maps["shear_stress"]
+    maps["X"], maps["Z"] = result["X"][0], result["Z"][0]
+    maps["ref_const"] = result["ref_const"]
+
+    return maps
+
+
+def save_map(path, maps, comp_depth, time=None):
+    with h5py.File(path, "w") as h5f:
+        for name in ("X", "Z") + COMPONENTS:
+            h5f.create_dataset(name, data=maps[name])
+        h5f.attrs["comp_depth"] = comp_depth
+        h5f.attrs["ref_const"] = maps["ref_const"]
+        if time is not None:
+            h5f.attrs["time"] = time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map view of the net stress, GPE and basal shear of the "
+                                                 "checkpoints of a 3D UWGeodynamics run.")
+    parser.add_argument("output_dir", help="model output directory, e.g. collision_0")
+    parser.add_argument("--results-dir", default=None,
+                        help="where to write the maps (default: <output_dir>/force_balance_map)")
+    parser.add_argument("--steps", type=int, nargs="+", default=None, help="checkpoints to process (default: all)")
+    parser.add_argument("--comp-depth", type=float, default=-200.0, help="compensation depth in km (default: -200)")
+    parser.add_argument("--reference-step", type=int, default=None,
+                        help="checkpoint whose pressure reference is used for all the maps "
+                             "(default: each checkpoint uses its own)")
+    args = parser.parse_args(argv)
+
+    steps = args.steps or uw_output.checkpoint_steps(args.output_dir, fb.TENSOR_FIELD)
+    if not steps:
+        parser.error("no {}-*.h5 checkpoint in {}".format(fb.TENSOR_FIELD, args.output_dir))
+    with uw_output.Checkpoint(args.output_dir, steps[0]) as checkpoint:
+        if checkpoint.dim != 3:
+            parser.error("{} is a 2D run, use force_balance_timeseries.py for its profiles".format(args.output_dir))
+
+    results_dir = args.results_dir or os.path.join(args.output_dir, "force_balance_map")
+    os.makedirs(results_dir, exist_ok=True)
+
+    ref_const = None
+    if args.reference_step is not None:
+        #The reference is the top corner element, in the first layer
+        ref_const = fb.checkpoint_force_balance(args.output_dir, args.reference_step, args.comp_depth,
+                                                z_index=0)["ref_const"]
+
+    for step in steps:
+        maps = map_force_balance(args.output_dir, step, args.comp_depth, ref_const)
+        path = os.path.join(results_dir, "{}-{}.h5".format(PREFIX, step))
+        save_map(path, maps, args.comp_depth, uw_output.checkpoint_time(args.output_dir, fb.TENSOR_FIELD, step))
+        print("checkpoint {} done, {} x {} map".format(step, *np.shape(maps["net_stress"])))
+
+
+if __name__ == "__main__":
+    main()
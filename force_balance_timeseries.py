@@ -0,0 +1,132 @@
+#################################################################################################################################
+# Evolution of the force balance through a whole UWGeodynamics run.
+# For every checkpoint of the output directory it reads pressureField-<step>.h5, projStressTensor-<step>.h5 and the mesh,
+# computes the net stress, the GPE, the basal shear force and their sum along x (force_balance.checkpoint_force_balance)
+# and appends them to a (time, x) HDF5 cube. Only the profiles are kept in memory, and running it again on the same
+# directory only processes the checkpoints added since the previous run.
+#
+# Usage:
+#   python force_balance_timeseries.py collision_0 --comp-depth -200 --z-index 48
+##############################################################################################################################
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+
+import force_balance as fb
+import uw_output
+
+COMPONENTS = ("net_stress", "GPE", "shear_stress", "total")
+DEFAULT_NAME = "force_balance_timeseries.h5"
+
+
+def checkpoint_profiles(output_dir, step, comp_depth=-200.0, z_index=None, ref_const=None):
+    """Force balance profiles of a checkpoint, with their sum ("total") and the x of the profiles."""
+    result = fb.checkpoint_force_balance(output_dir, step, comp_depth, z_index, ref_const)
+    result["total"] = result["net_stress"] + result["GPE"] + result["shear_stress"]
+
+    return result
+
+
+def _create(h5f, x, comp_depth, z_index, ref_const, output_dir):
+    h5f.create_dataset("x", data=x)
+    h5f.create_dataset("step", shape=(0,), maxshape=(None,), dtype=np.int64)
+    h5f.create_dataset("time", shape=(0,), maxshape=(None,), dtype=np.float64)
+    for name in COMPONENTS:
+        h5f.create_dataset(name, shape=(0, len(x)), maxshape=(None, len(x)), dtype=np.float64,
+                           chunks=(1, len(x)))
+    h5f.attrs["comp_depth"] = comp_depth
+    h5f.attrs["z_index"] = -1 if z_index is None else z_index
+    h5f.attrs["ref_const"] = ref_const
+    h5f.attrs["output_dir"] = os.path.abspath(output_dir)
+
+
+def _append(h5f, step, time, result):
+    n = len(h5f["step"])
+    for name in ("step", "time") + COMPONENTS:
+        h5f[name].resize(n + 1, axis=0)
+    h5f["step"][n] = step
+    h5f["time"][n] = np.nan if time is None else time
+    for name in COMPONENTS:
+        h5f[name][n] = result[name]
+
+
+def _sort_by_step(h5f):
+    """Reorder the rows when checkpoints older than the last stored one were added."""
+    steps = h5f["step"][()]
+    if np.all(np.diff(steps) > 0):
+        return
+    order = np.argsort(steps)
+    for name in ("step", "time") + COMPONENTS:
+        h5f[name][...] = h5f[name][()][order]
+
+
+def update_timeseries(output_dir, path=None, comp_depth=-200.0, z_index=None, steps=None):
+    """Add the checkpoints missing from the cube at path (default <output_dir>/force_balance_timeseries.h5).
+
+    The pressure reference of the isotropic stress is taken from the first checkpoint processed and stored
+    with the cube, so the later checkpoints are referred to it, as the post-collision section is referred to
+    the pre-collision one in force_balance.get_stress_GPE_shearV2. A 3D run is sampled on the element layer
+    z_index (default: the middle one). Returns the steps added.
+    """
+    path = path or os.path.join(output_dir, DEFAULT_NAME)
+    steps = steps or uw_output.checkpoint_steps(output_dir, fb.TENSOR_FIELD)
+    if z_index is None and steps:
+        with uw_output.Checkpoint(output_dir, steps[0]) as checkpoint:
+            resolution = checkpoint.resolution
+        z_index = resolution[2] // 2 if len(resolution) == 3 else None
+
+    added = []
+    with h5py.File(path, "a") as h5f:
+        if "step" in h5f:
+            stored_z = None if h5f.attrs["z_index"] < 0 else int(h5f.attrs["z_index"])
+            if h5f.attrs["comp_depth"] != comp_depth or stored_z != z_index:
+                raise ValueError("{} was computed with comp_depth={} and z_index={}, remove it to change them"
+                                 .format(path, h5f.attrs["comp_depth"], stored_z))
+            done = set(h5f["step"][()].tolist())
+            ref_const = h5f.attrs["ref_const"]
+        else:
+            done, ref_const = set(), None
+
+        for step in steps:
+            if step in done:
+                continue
+            result = checkpoint_profiles(output_dir, step, comp_depth, z_index, ref_const)
+            if "step" not in h5f:
+                ref_const = result["ref_const"]
+                _create(h5f, result["X"][0], comp_depth, z_index, ref_const, output_dir)
+            _append(h5f, step, uw_output.checkpoint_time(output_dir, fb.TENSOR_FIELD, step), result)
+            #Every checkpoint is on disk as soon as it is computed, an interrupted run resumes from there
+            h5f.flush()
+            added.append(step)
+            print("checkpoint {} done".format(step))
+
+        if added:
+            _sort_by_step(h5f)
+
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Net stress, GPE, basal shear and their sum along x for every "
+                                                 "checkpoint of a UWGeodynamics run.")
+    parser.add_argument("output_dir", help="model output directory, e.g. collision_0")
+    parser.add_argument("--output", default=None,
+                        help="HDF5 cube to create or update (default: <output_dir>/{})".format(DEFAULT_NAME))
+    parser.add_argument("--comp-depth", type=float, default=-200.0, help="compensation depth in km (default: -200)")
+    parser.add_argument("--z-index", type=int, default=None,
+                        help="element layer of the section in 3D runs (default: the middle one)")
+    parser.add_argument("--steps", type=int, nargs="+", default=None, help="checkpoints to process (default: all)")
+    args = parser.parse_args(argv)
+
+    if not (args.steps or uw_output.checkpoint_steps(args.output_dir, fb.TENSOR_FIELD)):
+        parser.error("no {}-*.h5 checkpoint in {}".format(fb.TENSOR_FIELD, args.output_dir))
+
+    added = update_timeseries(args.output_dir, args.output, args.comp_depth, args.z_index, args.steps)
+    print("{} checkpoints added to {}".format(len(added), args.output or os.path.join(args.output_dir, DEFAULT_NAME)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#################################################################################################################################
+# Principal stresses, stress number and fault regimes for stacks of stress tensors.
+# This module holds the numerical kernel used by the Paraview snippet PrincipalStresses.py, so the same
+# calculation can be imported from a notebook or a script.
+#
+# Every function works on a whole stack of tensors at once: the decomposition is a single stacked (N,3,3)
+# call instead of one LAPACK call per cell. Stress tensors can be dense (N,3,3) as Paraview gives them, or
+# packed as Underworld writes them (6 components in 3D, 3 components in 2D), see symmetric_eigen.tensor_components.
+#
+# stress_outputs processes the cells in chunks and writes into preallocated arrays, so the working memory is
+# bounded by max_memory whatever the size of the mesh. With workers > 1 the chunks are processed by a pool of
+# threads, NumPy releases the GIL in LAPACK and in the array operations so the chunks run on separate cores.
+# Each chunk writes to its own slice of the outputs, the result does not depend on the number of workers.
+##############################################################################################################################
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import symmetric_eigen
+
+#Arbitrary pressure used to make all the eigen values of the full tensor negative
+DEFAULT_PRESSURE = -5e8
+
+#Eigen solvers: "lapack" is np.linalg.eigh, "analytic" the closed form of symmetric_eigen.py with LAPACK fallback
+ENGINES = ("lapack", "analytic")
+DEFAULT_ENGINE = "lapack"
+
+#Default bound of the working memory of stress_outputs, in bytes
+DEFAULT_MAX_MEMORY = 256 * 2**20
+#Approximate number of temporary values held per cell while a chunk is processed
+_VALUES_PER_CELL = 64
+
+#Names of the arrays exported to Paraview
+OUTPUT_NAMES = ("2nd Invariant stress tensor",
+                "Dev More compressional", "Dev Intermediate", "Dev Less compressional",
+                "Full More compressional", "Full Intermediate", "Full Less compressional",
+                "More compressional", "Intermediate", "Less compressional",
+                "Stress number", "Fault regimes", "A phi")
+
+PrincipalStresses = namedtuple("PrincipalStresses", ["dev_values", "full_values", "vectors"])
+PrincipalStresses.__doc__ = """Principal stresses of a stack of tensors.
+
+dev_values  : (N,3) eigen values of the deviatoric tensor, from more to less compressional
+full_values : (N,3) eigen values of the full tensor (deviatoric + isotropic pressure)
+vectors     : (N,3,3) eigen vectors, column k belongs to dev_values[:,k]
+"""
+
+
+def eigen_decomposition(stress, engine=DEFAULT_ENGINE):
+    """Eigen values (ascending) and eigen vectors of a stack of symmetric tensors, dense or packed."""
+    if engine == "lapack":
+        return symmetric_eigen.lapack_eigh(stress)
+    if engine == "analytic":
+        return symmetric_eigen.analytic_eigh(stress)
+    raise ValueError("Unknown engine {!r}, expected one of {}".format(engine, ENGINES))
+
+
+def principal_stresses(dev_stress, pressure=DEFAULT_PRESSURE, engine=DEFAULT_ENGINE):
+    """Principal stresses of the deviatoric and of the full stress tensor.
+
+    The full tensor is the deviatoric tensor plus an isotropic pressure. An isotropic shift leaves
+    the eigen vectors unchanged and moves every eigen value by the same amount, so only the
+    deviatoric tensor is decomposed and the full eigen values are derived from it.
+
+    dev_stress : (N,3,3), (N,9), (N,6) or 2D (N,3) deviatoric stress tensors
+    pressure   : scalar or (N,) pressure added to the diagonal of the full tensor
+    engine     : eigen solver, one of ENGINES
+    """
+    dev_values, vectors = eigen_decomposition(dev_stress, engine)
+
+    pressure = np.asarray(pressure, dtype=dev_values.dtype)
+    full_values = dev_values + pressure.reshape(pressure.shape + (1,) * (2 - pressure.ndim))
+
+    return PrincipalStresses(dev_values, full_values, vectors)
+
+
+def scaled_vectors(values, vectors, second_invariant, scale=1e-6, out=None):
+    """Eigen vectors scaled by the principal stress over the second invariant.
+
+    Returns the (N,3) more compressional, intermediate and less compressional vectors, written into
+    the three arrays of out when given.
+    """
+    second_invariant = scale * np.asarray(second_invariant).reshape(-1)
+    if out is None:
+        out = tuple(np.empty(vectors.shape[:2], dtype=vectors.dtype) for k in range(3))
+
+    for k in range(3):
+        np.multiply((scale * values[:, k] / second_invariant)[:, None], vectors[:, :, k], out=out[k])
+
+    return tuple(out)
+
+
+def stress_regime(values, vectors, vertical_axis=1, out=None):
+    """Stress number, fault regime and A-phi regime index in a single pass over the eigen results.
+
+    values        : (N,3) principal stresses, from more to less compressional
+    vectors       : (N,3,3) eigen vectors, column k belongs to values[:,k]
+    vertical_axis : index of the axis parallel to gravity, 1 (Y) for the 2D and the 3D models
+    out           : optional (R, regimes, A_phi) arrays to write into
+
+    The regime codes are 1 normal, 2 strike-slip and 3 reverse. A-phi = (n + 0.5) + (-1)^n (R - 0.5),
+    with n = regime - 1, varies continuously from 0 (radial extension) to 3 (radial compression).
+    """
+    if vertical_axis not in (0, 1, 2):
+        raise ValueError("vertical_axis must be 0, 1 or 2, got {!r}".format(vertical_axis))
+    if out is None:
+        out = (np.empty(len(values), dtype=values.dtype), np.empty(len(values), dtype=int),
+               np.empty(len(values), dtype=values.dtype))
+    R, regimes, A_phi = out
+
+    S_mc, S_int, S_lc = values[:, 0], values[:, 1], values[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(S_int - S_lc, S_mc - S_lc, out=R)
+
+    vertical = np.abs(vectors[:, vertical_axis, :])
+    S_mc_v, S_int_v, S_lc_v = vertical[:, 0], vertical[:, 1], vertical[:, 2]
+    normal = (S_mc_v > S_int_v) & (S_mc_v > S_lc_v)
+    strike_slip = (S_int_v > S_mc_v) & (S_int_v > S_lc_v)
+    np.copyto(regimes, np.where(normal, 1, np.where(strike_slip, 2, 3)))
+
+    #(-1)^n is -1 only for strike-slip
+    n = regimes - 1
+    np.copyto(A_phi, n + 0.5 + np.where(strike_slip, -1., 1.) * (R - 0.5))
+
+    return R, regimes, A_phi
+
+
+def chunk_length(max_memory=DEFAULT_MAX_MEMORY, dtype=np.float64):
+    """Number of cells processed at once so the temporaries of a chunk fit in max_memory bytes."""
+    return max(1, int(max_memory // (_VALUES_PER_CELL * np.dtype(dtype).itemsize)))
+
+
+def allocate_outputs(n_cells, dtype=np.float64):
+    """Empty output arrays of stress_outputs for n_cells cells, keyed by the names in OUTPUT_NAMES."""
+    shapes = {"More compressional": (n_cells, 3), "Intermediate": (n_cells, 3), "Less compressional": (n_cells, 3)}
+
+    out = {name: np.empty(shapes.get(name, (n_cells,)), dtype=dtype) for name in OUTPUT_NAMES}
+    out["Fault regimes"] = np.empty(n_cells, dtype=int)
+
+    return out
+
+
+def _fill_chunk(out, index, dev_stress, second_invariant, pressure, scale, engine, dtype, vertical_axis):
+    """Compute the outputs of the cells in the slice index and write them into out."""
+    stress = dev_stress[index]
+    if dtype is not None:
+        stress = stress.astype(dtype, copy=False)
+    if pressure.ndim:
+        pressure = pressure[index]
+
+    #The full eigen values are the deviatoric ones shifted by the pressure (principal_stresses), they are
+    #written column by column into the outputs instead of building the (chunk,3) full_values array
+    values, vectors = eigen_decomposition(stress, engine)
+    pressure = pressure.astype(values.dtype, copy=False)
+    for k, name in enumerate(("Full More compressional", "Full Intermediate", "Full Less compressional")):
+        full = out[name][index]
+        np.add(values[:, k], pressure, out=full)
+        full *= scale
+    values *= scale
+
+    inv = out["2nd Invariant stress tensor"][index]
+    np.multiply(second_invariant[index], scale, out=inv)
+    out["Dev More compressional"][index] = values[:, 0]
+    out["Dev Intermediate"][index] = values[:, 1]
+    out["Dev Less compressional"][index] = values[:, 2]
+
+    scaled_vectors(values, vectors, inv, scale=1., out=(out["More compressional"][index],
+                                                         out["Intermediate"][index],
+                                                         out["Less compressional"][index]))
+    stress_regime(values, vectors, vertical_axis, out=(out["Stress number"][index],
+                                                        out["Fault regimes"][index],
+                                                        out["A phi"][index]))
+
+
+def stress_outputs(dev_stress, second_invariant, pressure=DEFAULT_PRESSURE, scale=1e-6, engine=DEFAULT_ENGINE,
+                   max_memory=DEFAULT_MAX_MEMORY, chunk_size=None, dtype=None, out=None, workers=1,
+                   vertical_axis=1):
+    """All the derived arrays of the Paraview filter, keyed by the names in OUTPUT_NAMES.
+
+    The cells are processed in chunks and the results written into preallocated arrays, the
+    temporaries of the eigen decomposition never exceed one chunk.
+
+    dev_stress       : dense or packed deviatoric stress tensors (projStressTensor)
+    second_invariant : (N,) second invariant of the stress tensor (projStressField)
+    scale            : conversion applied to the stresses, Pa to MPa by default
+    engine           : eigen solver, one of ENGINES
+    max_memory       : bound in bytes of the working memory, sets the chunk size
+    chunk_size       : number of cells per chunk, overrides max_memory
+    dtype            : compute precision, e.g. np.float32 to halve the memory, input precision by default
+    out              : preallocated outputs, as returned by allocate_outputs
+    workers          : number of threads processing chunks, None uses every core. max_memory is
+                       shared between the workers
+    vertical_axis    : axis parallel to gravity used by the fault regimes, 1 (Y) for the 2D and 3D models
+    """
+    dev_stress = np.asarray(dev_stress)
+    second_invariant = np.asarray(second_invariant).reshape(-1)
+    pressure = np.asarray(pressure)
+    n_cells = len(dev_stress)
+
+    compute_dtype = np.dtype(dtype if dtype is not None else np.result_type(dev_stress.dtype, np.float32))
+    if out is None:
+        out = allocate_outputs(n_cells, compute_dtype)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        #The closed form runs in float64 whatever the output precision (symmetric_eigen.analytic_eigh)
+        chunk_size = chunk_length(max_memory / workers, np.float64 if engine == "analytic" else compute_dtype)
+        #Enough chunks to keep every worker busy
+        chunk_size = max(1, min(chunk_size, -(-n_cells // workers)))
+
+    def fill(start):
+        _fill_chunk(out, slice(start, start + chunk_size), dev_stress, second_invariant, pressure,
+                    scale, engine, dtype, vertical_axis)
+
+    starts = range(0, n_cells, chunk_size)
+    if workers == 1 or len(starts) == 1:
+        for start in starts:
+            fill(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            #Consume the iterator so exceptions raised in a worker propagate
+            list(executor.map(fill, starts))
+
+    return out
@@ -0,0 +1,173 @@
+#################################################################################################################################
+# Command line version of the Paraview snippet PrincipalStresses.py for a whole UWGeodynamics run.
+# For every checkpoint of the output directory it reads projStressTensor-<step>.h5, projStressField-<step>.h5 and the
+# mesh, computes the deviatoric and full principal stresses, scaled eigen vectors, stress number, fault regimes and A phi,
+# and writes them to principalStresses-<step>.h5 with an XDMF file, so Paraview only has to open principalStresses.xdmf.
+#
+# Usage:
+#   python principal_stresses_batch.py collision_0 --jobs 8
+##############################################################################################################################
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+import principal_stresses as ps
+import uw_output
+
+PREFIX = "principalStresses"
+TENSOR_FIELD = "projStressTensor"
+INVARIANT_FIELD = "projStressField"
+
+#Underworld numbers the nodes of Q1 elements lexicographically, XDMF expects them around the faces
+_XDMF_NODE_ORDER = {4: [0, 1, 3, 2], 8: [0, 1, 3, 2, 4, 5, 7, 6]}
+_XDMF_TOPOLOGY = {4: "Quadrilateral", 8: "Hexahedron"}
+
+
+def _dataset_name(name):
+    return name.replace(" ", "_")
+
+
+def process_checkpoint(output_dir, step, results_dir, engine=ps.DEFAULT_ENGINE, pressure=ps.DEFAULT_PRESSURE,
+                       scale=1e-6, max_memory=ps.DEFAULT_MAX_MEMORY, workers=1, vertical_axis=1):
+    """Compute the outputs of one checkpoint and save them to <results_dir>/principalStresses-<step>.h5.
+
+    pressure is in Pa and scale converts from Pa, the fields are converted from their units attribute
+    as in force_balance.checkpoint_grids.
+    """
+    with uw_output.Checkpoint(output_dir, step) as checkpoint:
+        #Memory-mapped, stress_outputs reads them chunk by chunk
+        dev_stress = checkpoint.read(TENSOR_FIELD)
+        second_invariant = checkpoint.read(INVARIANT_FIELD)
+        time = checkpoint.time(TENSOR_FIELD)
+
+        #stress_outputs works in the units of the tensor, the invariant is only copied when its units differ
+        to_pascal = checkpoint.to_pascal(TENSOR_FIELD)
+        invariant_to_pascal = checkpoint.to_pascal(INVARIANT_FIELD)
+        if invariant_to_pascal != to_pascal:
+            second_invariant = second_invariant*(invariant_to_pascal/to_pascal)
+
+        outputs = ps.stress_outputs(dev_stress, second_invariant, pressure=pressure/to_pascal,
+                                    scale=scale*to_pascal, engine=engine,
+                                    max_memory=max_memory, workers=workers, vertical_axis=vertical_axis)
+        n_cells = len(dev_stress)
+
+    path = os.path.join(results_dir, "{}-{}.h5".format(PREFIX, step))
+    with h5py.File(path, "w") as h5f:
+        for name, array in outputs.items():
+            h5f.create_dataset(_dataset_name(name), data=array)
+        if time is not None:
+            h5f.attrs["time"] = time
+
+    return step, time, n_cells
+
+
+def write_topology(output_dir, step, results_dir):
+    """Save the element connectivity in XDMF node order, shared by every checkpoint."""
+    with uw_output.Checkpoint(output_dir, step) as checkpoint:
+        en_map = checkpoint.en_map[()]
+    path = os.path.join(results_dir, PREFIX + "-topology.h5")
+    with h5py.File(path, "w") as h5f:
+        h5f.create_dataset("connectivity", data=en_map[:, _XDMF_NODE_ORDER[en_map.shape[1]]])
+
+    return path
+
+
+def _data_item(path, dataset, array_shape, dtype, results_dir):
+    number_type = "Int" if np.issubdtype(dtype, np.integer) else "Float"
+    return ('<DataItem Format="HDF" NumberType="{}" Precision="{}" Dimensions="{}">{}:/{}</DataItem>'
+            .format(number_type, np.dtype(dtype).itemsize, " ".join(str(d) for d in array_shape),
+                    os.path.relpath(path, results_dir), dataset))
+
+
+def write_xdmf(output_dir, results, results_dir):
+    """Temporal XDMF collection of the computed checkpoints, results is a list of (step, time, n_cells)."""
+    topology_path = os.path.join(results_dir, PREFIX + "-topology.h5")
+    with h5py.File(topology_path, "r") as h5f:
+        n_cells, n_nodes = h5f["connectivity"].shape
+        topology_dtype = h5f["connectivity"].dtype
+
+    lines = ['<?xml version="1.0" ?>',
+             '<Xdmf xmlns:xi="http://www.w3.org/2001/XInclude" Version="2.0">',
+             '<Domain>',
+             '<Grid Name="{}" GridType="Collection" CollectionType="Temporal">'.format(PREFIX)]
+
+    for step, time, _ in results:
+        with uw_output.Checkpoint(output_dir, step) as checkpoint:
+            mesh_file = checkpoint.mesh_path
+            vertices_shape, vertices_dtype = checkpoint.vertices.shape, checkpoint.vertices.dtype
+        data_file = os.path.join(results_dir, "{}-{}.h5".format(PREFIX, step))
+
+        lines.append('<Grid Name="step_{}" GridType="Uniform">'.format(step))
+        lines.append('<Time Value="{}"/>'.format(step if time is None else time))
+        lines.append('<Topology Type="{}" NumberOfElements="{}">'.format(_XDMF_TOPOLOGY[n_nodes], n_cells))
+        lines.append(_data_item(topology_path, "connectivity", (n_cells, n_nodes), topology_dtype, results_dir))
+        lines.append('</Topology>')
+        lines.append('<Geometry Type="{}">'.format("XYZ" if vertices_shape[1] == 3 else "XY"))
+        lines.append(_data_item(mesh_file, "vertices", vertices_shape, vertices_dtype, results_dir))
+        lines.append('</Geometry>')
+
+        with h5py.File(data_file, "r") as h5f:
+            for name in ps.OUTPUT_NAMES:
+                dataset = h5f[_dataset_name(name)]
+                attribute_type = "Vector" if dataset.ndim == 2 else "Scalar"
+                lines.append('<Attribute Type="{}" Center="Cell" Name="{}">'.format(attribute_type, name))
+                lines.append(_data_item(data_file, _dataset_name(name), dataset.shape, dataset.dtype, results_dir))
+                lines.append('</Attribute>')
+        lines.append('</Grid>')
+
+    lines += ['</Grid>', '</Domain>', '</Xdmf>']
+
+    path = os.path.join(results_dir, PREFIX + ".xdmf")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Principal stresses and fault regimes of every checkpoint "
+                                                 "of a UWGeodynamics run.")
+    parser.add_argument("output_dir", help="model output directory, e.g. collision_0")
+    parser.add_argument("--results-dir", default=None,
+                        help="where to write the results (default: <output_dir>/principal_stresses)")
+    parser.add_argument("--steps", type=int, nargs="+", default=None, help="checkpoints to process (default: all)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="checkpoints processed in parallel (default: number of cores)")
+    parser.add_argument("--engine", choices=ps.ENGINES, default="analytic")
+    parser.add_argument("--pressure", type=float, default=ps.DEFAULT_PRESSURE,
+                        help="pressure added to the full tensor (Pa)")
+    parser.add_argument("--scale", type=float, default=1e-6, help="stress conversion from Pa, to MPa by default")
+    parser.add_argument("--max-memory", type=float, default=ps.DEFAULT_MAX_MEMORY / 2**20,
+                        help="working memory of each job in MB")
+    parser.add_argument("--vertical-axis", type=int, choices=(0, 1, 2), default=1,
+                        help="axis parallel to gravity for the fault regimes (default: 1, Y)")
+    args = parser.parse_args(argv)
+
+    output_dir = os.path.abspath(args.output_dir)
+    results_dir = args.results_dir or os.path.join(output_dir, "principal_stresses")
+    os.makedirs(results_dir, exist_ok=True)
+
+    steps = args.steps or uw_output.checkpoint_steps(output_dir, TENSOR_FIELD)
+    if not steps:
+        parser.error("no {}-*.h5 checkpoint in {}".format(TENSOR_FIELD, output_dir))
+
+    write_topology(output_dir, steps[0], results_dir)
+
+    jobs = args.jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_checkpoint, output_dir, step, results_dir, args.engine, args.pressure,
+                                   args.scale, args.max_memory * 2**20, 1, args.vertical_axis) for step in steps]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            print("checkpoint {} done ({} cells)".format(*results[-1][::2]))
+
+    print("Open {} in Paraview".format(write_xdmf(output_dir, results, results_dir)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#################################################################################################################################
+# Cache of the derived principal-stress arrays, for the Paraview filter PrincipalStresses.py.
+# Paraview executes the Programmable Filter again every time the display, the colormap or the time changes. The results
+# are stored under a key made of the timestep, a hash of the input buffers and the parameters of the calculation, so
+# revisiting a timestep returns the arrays without any eigen decomposition.
+#
+# The cache lives in memory with least-recently-used eviction and a size cap, and can also be kept on disk (one .npz
+# file per entry) so it survives a Paraview restart.
+##############################################################################################################################
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import principal_stresses as ps
+
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+
+def _nbytes(outputs):
+    return sum(array.nbytes for array in outputs.values())
+
+
+class StressCache:
+    """Least-recently-used cache of stress_outputs results.
+
+    max_bytes      : memory cap, the least recently used entries are evicted above it
+    cache_dir      : optional directory where the entries are also saved as .npz files
+    max_disk_bytes : cap of the disk cache, None for no cap
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.cache_dir is not None and os.path.exists(self._path(key)))
+
+    @property
+    def nbytes(self):
+        """Memory used by the in-memory entries."""
+        return self._size
+
+    @staticmethod
+    def key(timestep, *arrays, **params):
+        """Key of a timestep, the content of the input arrays and the parameters of the calculation."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((timestep, sorted(params.items()))).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.shape, array.dtype.str)).encode())
+            digest.update(memoryview(array).cast("B"))
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """Cached outputs of a key, None on a miss."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            with np.load(self._path(key)) as data:
+                outputs = {name: data[name] for name in data.files}
+            #Touch the file so the disk eviction is least recently used as well
+            os.utime(self._path(key))
+            self._store(key, outputs)
+            return outputs
+
+        return None
+
+    def put(self, key, outputs):
+        self._store(key, outputs)
+        if self.cache_dir is not None:
+            np.savez(self._path(key), **outputs)
+            self._evict_disk()
+
+    def _store(self, key, outputs):
+        size = _nbytes(outputs)
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._size -= _nbytes(self._entries.pop(key))
+        self._entries[key] = outputs
+        self._size += size
+
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= _nbytes(evicted)
+
+    def _evict_disk(self):
+        if self.max_disk_bytes is None:
+            return
+
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".npz")]
+        files.sort(key=os.path.getmtime)
+        size = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if size <= self.max_disk_bytes:
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def stress_outputs(self, timestep, dev_stress, second_invariant, **kwargs):
+        """principal_stresses.stress_outputs, computed only when the timestep and inputs are not cached.
+
+        The keyword arguments are passed to stress_outputs, the ones that change the result are part of the key.
+        """
+        params = {name: kwargs[name] for name in ("pressure", "scale", "engine", "dtype", "vertical_axis")
+                  if name in kwargs}
+        if "dtype" in params:
+            params["dtype"] = None if params["dtype"] is None else np.dtype(params["dtype"]).str
+        arrays = [dev_stress, second_invariant]
+        #A per-cell pressure is hashed with the inputs
+        if np.ndim(params.get("pressure", 0)):
+            arrays.append(params.pop("pressure"))
+        #Entries saved before a change of the output arrays are not reused
+        key = self.key(timestep, *arrays, outputs=ps.OUTPUT_NAMES, **params)
+
+        outputs = self.get(key)
+        if outputs is None:
+            outputs = ps.stress_outputs(dev_stress, second_invariant, **kwargs)
+            self.put(key, outputs)
+
+        return outputs
+
+
+#Cache shared by every execution of the Paraview filter in the same session
+default_cache = StressCache()
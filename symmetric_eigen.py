@@ -0,0 +1,183 @@
+#################################################################################################################################
+# Closed-form eigen values and eigen vectors of stacks of 3x3 symmetric tensors (stress, strain rate).
+# The eigen values come from the trigonometric solution of the characteristic cubic and the eigen vectors from cross
+# products of the rows of (A - lambda*I), everything written as NumPy array operations over the whole stack.
+#
+# Near degenerate tensors (two eigen values close to each other) lose precision in the closed form, those cells are
+# detected and solved again with LAPACK (np.linalg.eigh). The closed form is always evaluated in double precision,
+# single precision tensors are promoted and the results cast back, as the degeneracy tolerance is set for float64.
+#
+# Tensors can be given dense, (N,3,3) or (N,9), or packed as Underworld stores symmetric tensors (count=6 in 3D,
+# count=3 in 2D). Packed tensors are read as column views and are never expanded to dense (N,3,3) arrays, except
+# for the few degenerate cells sent to LAPACK.
+##############################################################################################################################
+
+import numpy as np
+
+#Relative eigen value gap below which a tensor is considered degenerate and sent to LAPACK
+DEGENERACY_TOL = 1e-3
+
+#Component order of the packed symmetric tensors written by Underworld (projStressTensor, strainRate)
+PACKED_3D = ("xx", "yy", "zz", "xy", "xz", "yz")
+PACKED_2D = ("xx", "yy", "xy")
+
+
+def tensor_components(tensors):
+    """The six independent components (a00, a11, a22, a01, a02, a12) of a stack of symmetric tensors.
+
+    Accepts dense (N,3,3) or (N,9) tensors, packed (N,6) tensors in the PACKED_3D order, and 2D tensors,
+    dense (N,2,2) or packed (N,3) in the PACKED_2D order. 2D tensors are embedded in 3D with zero
+    out-of-plane components (plane strain). The components are views of the input, no data is copied.
+    """
+    tensors = np.asarray(tensors)
+
+    if tensors.ndim == 3 and tensors.shape[1:] == (3, 3):
+        return (tensors[:, 0, 0], tensors[:, 1, 1], tensors[:, 2, 2],
+                tensors[:, 0, 1], tensors[:, 0, 2], tensors[:, 1, 2])
+    if tensors.ndim == 3 and tensors.shape[1:] == (2, 2):
+        zero = np.broadcast_to(tensors.dtype.type(0), tensors.shape[:1])
+        return tensors[:, 0, 0], tensors[:, 1, 1], zero, tensors[:, 0, 1], zero, zero
+    if tensors.ndim == 2 and tensors.shape[1] == 9:
+        return tensors[:, 0], tensors[:, 4], tensors[:, 8], tensors[:, 1], tensors[:, 2], tensors[:, 5]
+    if tensors.ndim == 2 and tensors.shape[1] == 6:
+        return tuple(tensors[:, k] for k in range(6))
+    if tensors.ndim == 2 and tensors.shape[1] == 3:
+        zero = np.broadcast_to(tensors.dtype.type(0), tensors.shape[:1])
+        return tensors[:, 0], tensors[:, 1], zero, tensors[:, 2], zero, zero
+
+    raise ValueError("Unsupported tensor layout with shape {}, expected (N,3,3), (N,9), (N,6), (N,2,2) "
+                     "or (N,3)".format(tensors.shape))
+
+
+def dense(a00, a11, a22, a01, a02, a12, index=None):
+    """Dense (N,3,3) tensors built from the six components, only for the cells selected by index."""
+    components = np.broadcast_arrays(a00, a11, a22, a01, a02, a12)
+    if index is not None:
+        components = [c[index] for c in components]
+    a00, a11, a22, a01, a02, a12 = components
+
+    tensors = np.empty(a00.shape + (3, 3), dtype=np.result_type(*components))
+    tensors[:, 0, 0], tensors[:, 1, 1], tensors[:, 2, 2] = a00, a11, a22
+    tensors[:, 0, 1], tensors[:, 0, 2], tensors[:, 1, 2] = a01, a02, a12
+    tensors[:, 1, 0], tensors[:, 2, 0], tensors[:, 2, 1] = a01, a02, a12
+
+    return tensors
+
+
+def _cross(u, v):
+    return (u[1]*v[2] - u[2]*v[1], u[2]*v[0] - u[0]*v[2], u[0]*v[1] - u[1]*v[0])
+
+
+def _eigen_vector(a00, a11, a22, a01, a02, a12, lam):
+    """Unit eigen vector of every tensor for the (simple) eigen value lam, as an (N,3) array."""
+    r0 = (a00 - lam, a01, a02)
+    r1 = (a01, a11 - lam, a12)
+    r2 = (a02, a12, a22 - lam)
+
+    #The rows of (A - lam*I) span the plane normal to the eigen vector, keep the largest of the three cross products
+    crosses = np.stack([np.stack(np.broadcast_arrays(*_cross(u, v)), axis=-1)
+                        for u, v in ((r0, r1), (r0, r2), (r1, r2))])
+    norms = np.einsum("kni,kni->kn", crosses, crosses)
+    best = np.argmax(norms, axis=0)
+    vec = np.take_along_axis(crosses, best[None, :, None], axis=0)[0]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return vec / np.sqrt(np.take_along_axis(norms, best[None, :], axis=0)[0])[:, None]
+
+
+def analytic_components(a00, a11, a22, a01, a02, a12, tol=DEGENERACY_TOL):
+    """Closed-form eigen decomposition from the six independent components of the tensors.
+
+    Returns the (N,3) eigen values in ascending order, the (N,3,3) eigen vectors (column k belongs to
+    eigen value k, as np.linalg.eigh) and a boolean (N,) mask of the degenerate tensors, whose values are
+    not reliable and must be recomputed.
+    """
+    a00, a11, a22, a01, a02, a12 = np.broadcast_arrays(a00, a11, a22, a01, a02, a12)
+
+    #Shift by the mean so the cubic is solved for the deviatoric part
+    q = (a00 + a11 + a22) / 3.
+    b00, b11, b22 = a00 - q, a11 - q, a22 - q
+    p = np.sqrt((b00*b00 + b11*b11 + b22*b22 + 2.*(a01*a01 + a02*a02 + a12*a12)) / 6.)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = (b00*(b11*b22 - a12*a12) - a01*(a01*b22 - a12*a02) + a02*(a01*a12 - b11*a02))
+        r = np.clip(0.5 * det / (p*p*p), -1., 1.)
+    r = np.where(p > 0., r, 0.)
+
+    phi = np.arccos(r) / 3.
+    lam_max = q + 2.*p*np.cos(phi)
+    lam_min = q + 2.*p*np.cos(phi + 2.*np.pi/3.)
+    lam_mid = 3.*q - lam_max - lam_min
+
+    #The eigen values spread over at most 2*sqrt(3)*p, a small gap relative to p means a near repeated root
+    gap = np.minimum(lam_mid - lam_min, lam_max - lam_mid)
+    degenerate = ~(gap > tol * 2. * p)
+
+    v_min = _eigen_vector(a00, a11, a22, a01, a02, a12, lam_min)
+    v_max = _eigen_vector(a00, a11, a22, a01, a02, a12, lam_max)
+    #Complete an orthonormal basis
+    v_mid = np.cross(v_max, v_min)
+    v_max = np.cross(v_min, v_mid)
+
+    values = np.stack((lam_min, lam_mid, lam_max), axis=-1)
+    vectors = np.stack((v_min, v_mid, v_max), axis=-1)
+    degenerate |= ~np.isfinite(vectors).all(axis=(1, 2))
+
+    return values, vectors, degenerate
+
+
+def _float64_components(tensors):
+    """tensor_components in double precision and the floating point type of the input."""
+    components = tensor_components(tensors)
+    dtype = np.result_type(*components, np.float32)
+
+    return tuple(np.asarray(c, dtype=np.float64) for c in components), dtype
+
+
+def analytic_eigh(tensors, tol=DEGENERACY_TOL):
+    """Drop-in replacement of np.linalg.eigh for stacks of symmetric tensors, in any tensor_components layout.
+
+    Uses the closed form and falls back to LAPACK for the near degenerate tensors. The results have the
+    precision of the input, the closed form itself runs in float64.
+    """
+    components, dtype = _float64_components(tensors)
+    values, vectors, degenerate = analytic_components(*components, tol=tol)
+
+    if degenerate.any():
+        values[degenerate], vectors[degenerate] = np.linalg.eigh(dense(*components, index=degenerate))
+
+    return values.astype(dtype, copy=False), vectors.astype(dtype, copy=False)
+
+
+def lapack_eigh(tensors):
+    """np.linalg.eigh for stacks of symmetric tensors in any tensor_components layout.
+
+    LAPACK needs dense matrices, packed tensors are expanded before the call.
+    """
+    tensors = np.asarray(tensors)
+    if tensors.ndim == 3 and tensors.shape[1:] == (3, 3):
+        return np.linalg.eigh(tensors)
+
+    return np.linalg.eigh(dense(*tensor_components(tensors)))
+
+
+def max_deviation(tensors, tol=DEGENERACY_TOL):
+    """Largest deviation of the closed-form solver from np.linalg.eigh over a dataset.
+
+    Returns a dictionary with the maximum absolute eigen value difference, the same difference relative to
+    the largest eigen value magnitude of the dataset, the maximum eigen vector misalignment (1 - |cos|),
+    and the number of tensors sent to LAPACK.
+    """
+    values, vectors, degenerate = analytic_components(*_float64_components(tensors)[0], tol=tol)
+    ref_values, ref_vectors = lapack_eigh(tensors)
+
+    #Degenerate tensors are solved by LAPACK, they do not contribute to the deviation
+    ok = ~degenerate
+    value_dev = np.abs(values[ok] - ref_values[ok]).max(initial=0.)
+    vector_dev = (1. - np.abs(np.einsum("nik,nik->nk", vectors[ok], ref_vectors[ok]))).max(initial=0.)
+    scale = np.abs(ref_values).max(initial=0.)
+
+    return {"values": value_dev,
+            "values_relative": value_dev / scale if scale > 0. else 0.,
+            "vectors": vector_dev,
+            "fallback": int(degenerate.sum())}
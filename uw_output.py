@@ -0,0 +1,282 @@
+#################################################################################################################################
+# Reader of the HDF5 checkpoints written by UWGeodynamics in a model output directory (e.g. "collision_0").
+# Fields are saved as <field>-<step>.h5 with the values in the "data" dataset, the mesh as mesh-<step>.h5 (or a single
+# mesh.h5) with the "vertices" and "en_map" datasets.
+#
+# Checkpoint gives lazy access to the files of one step: datasets are only read when sliced, contiguous datasets are
+# memory-mapped, and the components of vectors and symmetric tensors can be selected by name in the 2D or 3D order
+# used by Underworld. The functions below it are shortcuts for single reads.
+##############################################################################################################################
+
+import glob
+import os
+import re
+
+import h5py
+import numpy as np
+
+#Order of the components in the checkpoints
+VECTOR_COMPONENTS = {2: ("x", "y"), 3: ("x", "y", "z")}
+TENSOR_COMPONENTS = {2: ("xx", "yy", "xy"), 3: ("xx", "yy", "zz", "xy", "xz", "yz")}
+
+#Conversion of the checkpoint units to Pa and km, fields without units are taken as Pa and km
+TO_PASCAL = {None: 1., "pascal": 1., "Pa": 1., "kilopascal": 1e3, "kPa": 1e3, "megapascal": 1e6, "MPa": 1e6,
+             "gigapascal": 1e9, "GPa": 1e9}
+TO_KILOMETER = {None: 1., "kilometer": 1., "km": 1., "meter": 1e-3, "m": 1e-3}
+
+
+def checkpoint_steps(output_dir, field):
+    """Sorted checkpoint numbers available for a field in a model output directory."""
+    pattern = re.compile(re.escape(field) + r"-(\d+)\.h5$")
+    steps = []
+    for path in glob.glob(os.path.join(output_dir, field + "-*.h5")):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            steps.append(int(match.group(1)))
+
+    return sorted(steps)
+
+
+def field_path(output_dir, field, step):
+    return os.path.join(output_dir, "{}-{}.h5".format(field, step))
+
+
+def mesh_path(output_dir, step):
+    """Mesh file of a checkpoint, the mesh is saved once (mesh.h5) when it does not deform."""
+    path = os.path.join(output_dir, "mesh-{}.h5".format(step))
+    if os.path.exists(path):
+        return path
+
+    path = os.path.join(output_dir, "mesh.h5")
+    if os.path.exists(path):
+        return path
+
+    raise FileNotFoundError("No mesh file for checkpoint {} in {}".format(step, output_dir))
+
+
+def element_resolution(en_map):
+    """Number of elements along each axis (nx, ny[, nz]) of a structured Q1 mesh from its element to node map.
+
+    Underworld numbers the nodes and the elements lexicographically, x first, so the first element
+    holds nodes 0, 1, nx+1, nx+2 (and (nx+1)(ny+1) for the upper face in 3D).
+    """
+    n_elements = len(en_map)
+    first = np.asarray(en_map[0])
+    nx = int(first[2] - first[0]) - 1
+    if len(first) == 4:
+        return nx, n_elements // nx
+
+    ny = int(first[4] - first[0]) // (nx + 1) - 1
+    return nx, ny, n_elements // (nx*ny)
+
+
+def _units(dataset):
+    units = dataset.attrs.get("units", dataset.file.attrs.get("units"))
+    if units is None:
+        return None
+
+    units = np.ravel(units)[0]
+    return units.decode() if isinstance(units, bytes) else str(units)
+
+
+def unit_factor(units, table, name):
+    """Factor converting values in units to the unit of table (TO_PASCAL or TO_KILOMETER)."""
+    if units not in table:
+        raise ValueError("Unsupported units {!r} for {}, expected one of {}".format(
+            units, name, sorted(key for key in table if key is not None)))
+    return table[units]
+
+
+def _time(value):
+    """Model time of a time attribute, saved as a number or as a string with units ("10.5 megayear")."""
+    if value is None:
+        return None
+
+    value = np.ravel(value)[0]
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        match = re.match(r"\s*([-+0-9.eE]+)", value)
+        return float(match.group(1)) if match else None
+
+    return float(value)
+
+
+class Checkpoint:
+    """Lazy access to the mesh and the fields of one checkpoint of a model output directory.
+
+    The files are opened on first use and stay open until close() or the end of a with block. The
+    component names of read() are the ones of VECTOR_COMPONENTS and TENSOR_COMPONENTS for the dimension
+    of the mesh.
+    """
+
+    def __init__(self, output_dir, step):
+        self.output_dir = output_dir
+        self.step = step
+        self._files = {}
+        self._resolution = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for h5f in self._files.values():
+            h5f.close()
+        self._files.clear()
+
+    def _file(self, path):
+        if path not in self._files:
+            self._files[path] = h5py.File(path, "r")
+        return self._files[path]
+
+    def field_path(self, field):
+        return field_path(self.output_dir, field, self.step)
+
+    @property
+    def mesh_path(self):
+        return mesh_path(self.output_dir, self.step)
+
+    def fields(self):
+        """Names of the fields saved at this checkpoint."""
+        suffix = "-{}.h5".format(self.step)
+        return sorted(os.path.basename(path)[:-len(suffix)]
+                      for path in glob.glob(os.path.join(self.output_dir, "*" + suffix))
+                      if not os.path.basename(path).startswith("mesh-"))
+
+    def dataset(self, field):
+        """h5py dataset of a field, nothing is read until it is sliced."""
+        return self._file(self.field_path(field))["data"]
+
+    @property
+    def vertices(self):
+        return self._file(self.mesh_path)["vertices"]
+
+    @property
+    def en_map(self):
+        return self._file(self.mesh_path)["en_map"]
+
+    @property
+    def dim(self):
+        return self.vertices.shape[1]
+
+    @property
+    def resolution(self):
+        """element_resolution of the mesh, only the first element is read."""
+        if self._resolution is None:
+            self._resolution = element_resolution(self.en_map)
+        return self._resolution
+
+    @staticmethod
+    def memmap(dataset):
+        """Read-only memory map of a contiguous, uncompressed h5py dataset, None for chunked datasets."""
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.size == 0:
+            return None
+
+        return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape)
+
+    def component_names(self, field):
+        """Names of the components of a field (VECTOR_COMPONENTS or TENSOR_COMPONENTS), None for other counts."""
+        shape = self.dataset(field).shape
+        count = shape[1] if len(shape) == 2 else 1
+        for names in (VECTOR_COMPONENTS[self.dim], TENSOR_COMPONENTS[self.dim]):
+            if count == len(names):
+                return names
+        return None
+
+    def _component_indices(self, field, components):
+        if isinstance(components, (str, int)):
+            return self._component_indices(field, [components])[0]
+
+        names = self.component_names(field)
+        indices = []
+        for component in components:
+            if isinstance(component, str):
+                if names is None or component not in names:
+                    raise KeyError("{} has no component {!r} in {}D (components: {})".format(
+                        field, component, self.dim, names))
+                component = names.index(component)
+            indices.append(component)
+        return indices
+
+    def read(self, field, components=None, rows=None):
+        """Values of a field, (N,) for scalars and (N,count) otherwise.
+
+        components : a name or an index (the result is then (N,)) or a list of them
+        rows       : slice of the rows to read
+
+        Contiguous datasets are read through a memory map, a full read of such a field returns the map
+        itself.
+        """
+        dataset = self.dataset(field)
+        data = self.memmap(dataset)
+        rows = slice(None) if rows is None else rows
+
+        if components is None:
+            data = dataset[rows] if data is None else data[rows]
+            return data[:, 0] if data.ndim == 2 and data.shape[1] == 1 else data
+
+        indices = self._component_indices(field, components)
+        if data is not None:
+            return np.array(data[rows][:, indices])
+        #h5py needs increasing indices
+        order = np.argsort(np.ravel(indices))
+        selected = dataset[rows, [np.ravel(indices)[k] for k in order]][:, np.argsort(order)]
+
+        return selected[:, 0] if np.ndim(indices) == 0 else selected
+
+    def units(self, field):
+        """Units attribute of a field ("megapascal"...), None when it has none."""
+        return _units(self.dataset(field))
+
+    def mesh_units(self):
+        """Units attribute of the mesh vertices ("kilometer"...), None when it has none."""
+        return _units(self.vertices)
+
+    def to_pascal(self, field):
+        """Factor converting a stress or pressure field to Pa, from its units attribute."""
+        return unit_factor(self.units(field), TO_PASCAL, field)
+
+    def mesh_to_kilometer(self):
+        """Factor converting the mesh vertices to km, from their units attribute."""
+        return unit_factor(self.mesh_units(), TO_KILOMETER, "the mesh")
+
+    def time(self, field):
+        """Model time stored with a field, None when the file has no time attribute."""
+        return _time(self._file(self.field_path(field)).attrs.get("time"))
+
+    def centroids(self, rows=None):
+        """Centroids of the elements (all of them or a slice)."""
+        vertices = self.vertices[()]
+        en_map = self.en_map[slice(None) if rows is None else rows]
+
+        #Node by node, to avoid a (N,nodes,dim) temporary on large meshes
+        centroids = vertices[en_map[:, 0]]
+        for node in range(1, en_map.shape[1]):
+            centroids += vertices[en_map[:, node]]
+
+        return centroids / en_map.shape[1]
+
+
+def read_field(output_dir, field, step, rows=None, components=None):
+    """Checkpoint.read of a single field, the result is an array in memory."""
+    with Checkpoint(output_dir, step) as checkpoint:
+        return np.array(checkpoint.read(field, components, rows))
+
+
+def read_mesh(output_dir, step):
+    """Vertices (M,dim) and element to node map (N,nodes) of the mesh of a checkpoint."""
+    with Checkpoint(output_dir, step) as checkpoint:
+        return checkpoint.vertices[()], checkpoint.en_map[()]
+
+
+def checkpoint_time(output_dir, field, step):
+    """Model time stored with a field checkpoint, None when the file has no time attribute.
+
+    The time can be saved as a number or as a string with units ("10.5 megayear"), only the value is returned.
+    """
+    with Checkpoint(output_dir, step) as checkpoint:
+        return checkpoint.time(field)